@@ -1,37 +1,145 @@
 import ast
+import gzip
+import hashlib
 import json
 import os
 import shutil
 import subprocess
+import sys
 import warnings
 
-import jupytext
-
 import bsparallel
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import notebooks
+import pysource
+
 
 warnings.filterwarnings("ignore", message="invalid escape sequence")
 
 
-def get_docstrings(syntax_tree):
-    docstrings = []
-    for node in ast.walk(syntax_tree):
-        if isinstance(node, (ast.FunctionDef, ast.ClassDef, ast.Module)):
-            docstring = ast.get_docstring(node)
-            if docstring:
-                docstrings.append(docstring)
-    return docstrings
+# everything either pipeline wants from a Python file, in one walk of its syntax tree: the
+# docstrings and imports here, and step5.py's import counts and references to each library (as its "data")
+extract_outputs = ("docstrings", "imports", "top", "nested", "references")
+libraries = pysource.default_libraries
+
+
+def extract(syntax_tree, thisfile, text=()):
+    data = pysource.extract(syntax_tree, extract_outputs, libraries)
+    thisfile["text"] = list(text) + data.pop("docstrings")
+    thisfile["imports"] = data.pop("imports")
+    thisfile["data"] = data
+
+
+class RepoRecord:
+    """One repo's line of output, written file by file to a gzipped temporary file.
+
+    Only one file's entry is in memory at a time, and the output appears under its final name (by
+    rename) only when it's complete. A text file with the same text as an earlier one in the repo
+    (a README or LICENSE copied into many directories) is {"name": ..., "same_text_as": earlier name}.
+    """
+
+    def __init__(self, repo_name, output_filename):
+        self.output_filename = output_filename
+        self.file = gzip.open(output_filename + ".tmp", "wt", encoding="utf-8", compresslevel=6)
+        # the same bytes as json.dump({"repo": ..., "success": True, "files": [...]}), a piece at a time
+        self.file.write('{"repo": ' + json.dumps(repo_name) + ', "success": true, "files": [')
+        self.num_files = 0
+        self.texts = {}
+
+    def add_text(self, thisfile, text):
+        digest = hashlib.sha256(text.encode("utf-8", errors="surrogateescape")).digest()
+        first = self.texts.setdefault(digest, thisfile["name"])
+        if first == thisfile["name"]:
+            thisfile["text"] = [text]
+        else:
+            thisfile["same_text_as"] = first
+
+    def add(self, thisfile):
+        if self.num_files != 0:
+            self.file.write(", ")
+        self.file.write(json.dumps(thisfile))
+        self.num_files += 1
 
+    def commit(self):
+        self.file.write("]}\n")
+        self.file.close()
+        os.replace(self.output_filename + ".tmp", self.output_filename)
 
-def get_imports(syntax_tree):
-    imports = set()
-    for node in ast.walk(syntax_tree):
-        if isinstance(node, ast.Import):
-            for alias in node.names:
-                imports.add(alias.name)
-        elif isinstance(node, ast.ImportFrom):
-            imports.add("." * node.level + ("" if node.module is None else node.module))
-    return sorted(imports)
+    def discard(self):
+        self.file.close()
+        os.remove(self.output_filename + ".tmp")
+
+
+def write_failure(repo_name, output_filename):
+    with gzip.open(output_filename + ".tmp", "wt", encoding="utf-8") as output:
+        json.dump({"repo": repo_name, "success": False}, output)
+        output.write("\n")
+    os.replace(output_filename + ".tmp", output_filename)
+
+
+def walk_repo(repo_name, record):
+    for subdir, dirs, filenames in os.walk(f"REPO/{repo_name}", followlinks=False):
+        for filename in filenames:
+            fullname = f"{subdir}/{filename}"
+
+            if os.path.islink(fullname):
+                continue
+
+            thisfile = {"name": fullname[len(f"REPO/{repo_name}") :]}
+
+            f = filename.lower()
+            if f.endswith(".py") or f.endswith(".pyi"):
+                with open(
+                    fullname, encoding="utf-8", errors="surrogateescape"
+                ) as file:
+                    python_source = file.read()
+
+                    try:
+                        syntax_tree = ast.parse(python_source)
+                    except:
+                        thisfile["parse"] = False
+                    else:
+                        thisfile["parse"] = True
+                        extract(syntax_tree, thisfile)
+
+            elif f.endswith(".ipynb"):
+                with open(
+                    fullname, encoding="utf-8", errors="surrogateescape"
+                ) as file:
+                    try:
+                        python_source, all_markdown = notebooks.notebook_source(
+                            file.read()
+                        )
+                        syntax_tree = ast.parse(python_source)
+                    except:
+                        thisfile["parse"] = False
+                    else:
+                        thisfile["parse"] = True
+                        extract(syntax_tree, thisfile, all_markdown)
+
+            elif (
+                f.endswith(".md")
+                or f.endswith(".mkd")
+                or f.endswith(".mdwn")
+                or f.endswith(".mdown")
+                or f.endswith(".mdtxt")
+                or f.endswith(".mdtext")
+                or f.endswith(".mdml")
+                or f.endswith(".markdown")
+                or f.endswith(".rst")
+                or f.endswith(".txt")
+                or f.endswith(".text")
+                or f.endswith(".htm")
+                or f.endswith(".html")
+                or "readme" in f
+            ):
+                with open(
+                    fullname, encoding="utf-8", errors="surrogateescape"
+                ) as file:
+                    record.add_text(thisfile, file.read(512000))
+
+            record.add(thisfile)
 
 
 def get_repo(repo_name):
@@ -42,11 +150,7 @@ def get_repo(repo_name):
     except FileExistsError:
         pass
 
-    output_filename = f"RESULTS/{repo_name}.json"
-
-    with open(output_filename, "w") as output:
-        json.dump({"repo": repo_name, "success": False}, output)
-        output.write("\n")
+    output_filename = f"RESULTS/{repo_name}.json.gz"
 
     try:
         subprocess.run(
@@ -64,83 +168,18 @@ def get_repo(repo_name):
         )
 
     except:
-        pass
+        write_failure(repo_name, output_filename)
 
     else:
-        thesefiles = []
-        for subdir, dirs, filenames in os.walk(f"REPO/{repo_name}", followlinks=False):
-            for filename in filenames:
-                fullname = f"{subdir}/{filename}"
-
-                if os.path.islink(fullname):
-                    continue
-
-                thisfile = {"name": fullname[len(f"REPO/{repo_name}") :]}
-
-                f = filename.lower()
-                if f.endswith(".py") or f.endswith(".pyi"):
-                    with open(
-                        fullname, encoding="utf-8", errors="surrogateescape"
-                    ) as file:
-                        python_source = file.read()
-
-                        try:
-                            syntax_tree = ast.parse(python_source)
-                        except:
-                            thisfile["parse"] = False
-                        else:
-                            thisfile["parse"] = True
-                            thisfile["text"] = get_docstrings(syntax_tree)
-                            thisfile["imports"] = get_imports(syntax_tree)
-
-                elif f.endswith(".ipynb"):
-                    with open(
-                        fullname, encoding="utf-8", errors="surrogateescape"
-                    ) as file:
-                        try:
-                            notebook = jupytext.reads(file.read())
-                            all_markdown = [
-                                x["source"]
-                                for x in notebook["cells"]
-                                if x["cell_type"] == "markdown"
-                            ]
-                            python_source = jupytext.writes(notebook, fmt="py:percent")
-                            syntax_tree = ast.parse(python_source)
-                        except:
-                            thisfile["parse"] = False
-                        else:
-                            thisfile["parse"] = True
-                            thisfile["text"] = all_markdown + get_docstrings(
-                                syntax_tree
-                            )
-                            thisfile["imports"] = get_imports(syntax_tree)
-
-                elif (
-                    f.endswith(".md")
-                    or f.endswith(".mkd")
-                    or f.endswith(".mdwn")
-                    or f.endswith(".mdown")
-                    or f.endswith(".mdtxt")
-                    or f.endswith(".mdtext")
-                    or f.endswith(".mdml")
-                    or f.endswith(".markdown")
-                    or f.endswith(".rst")
-                    or f.endswith(".txt")
-                    or f.endswith(".text")
-                    or f.endswith(".htm")
-                    or f.endswith(".html")
-                    or "readme" in f
-                ):
-                    with open(
-                        fullname, encoding="utf-8", errors="surrogateescape"
-                    ) as file:
-                        thisfile["text"] = [file.read(512000)]
-
-                thesefiles.append(thisfile)
-
-        with open(output_filename, "w") as output:
-            json.dump({"repo": repo_name, "success": True, "files": thesefiles}, output)
-            output.write("\n")
+        record = RepoRecord(repo_name, output_filename)
+        try:
+            walk_repo(repo_name, record)
+        except:
+            record.discard()
+            write_failure(repo_name, output_filename)
+            raise
+        else:
+            record.commit()
 
     finally:
         try:
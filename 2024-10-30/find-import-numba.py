@@ -1,37 +1,175 @@
-import tarfile
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import io
 import json
+import os
+import re
+import sys
+import tarfile
+import zlib
 
-with open("import-numba.jsonl", "w") as output:
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import jsonscan
 
-    num_import_numba = 0
-    num_and_has_readme = 0
-    num_total = 0
-    with tarfile.open("numba-dependents-contents.tgz") as tfile:
+contents_filename = "numba-dependents-contents.tgz"
+
+# The original tarball is one gzip stream, which can only be read from the start (Python's zlib
+# can't resume inflating mid-stream), so the first run rewrites it once as a tarball of the same
+# members in which each member is compressed as a gzip stream of its own. Concatenated gzip streams
+# are still a valid .tgz, and the index says where each member starts, so that workers can seek to
+# their members and decompress only those.
+seekable_filename = "numba-dependents-contents.seekable.tgz"
+index_filename = "numba-dependents-contents.index.json"
+
+
+def gzip_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def build_index():
+    index = []
+    offset = 0
+    with open(seekable_filename + ".tmp", "wb") as output, tarfile.open(contents_filename, "r|gz") as tfile:
         for tinfo in tfile:
-            print(f"=== {tinfo.name} ====================================================")
-            with tfile.extractfile(tinfo) as file:
-                for line in file:
-                    data = json.loads(line)
-
-                    imports_numba = False
-                    if data["success"]:
-                        for f in data["files"]:
-                            if any(x == "numba" or x.startswith("numba.") for x in f.get("imports", [])):
-                                imports_numba = True
-                                break
-
-                        readme = None
-                        if imports_numba:
-                            for f in data["files"]:
-                                if f["name"] == "/README.md":
-                                    num_and_has_readme += 1
-                                    readme = f["text"][0]
-                                    break
-
-                        num_total += 1
-                        if imports_numba:
-                            num_import_numba += 1
-                            print(f"{num_import_numba} / {num_total} = {num_import_numba / num_total}; and has README: {num_and_has_readme} / {num_import_numba} = {num_and_has_readme / num_import_numba}")
-
-                            output.write(json.dumps({"repo": data["repo"], "readme": readme}))
-                            output.write("\n")
+            print(f"indexing {tinfo.name}")
+            header = tinfo.tobuf(tfile.format, tfile.encoding, tfile.errors)
+            data = b"" if not tinfo.isfile() else tfile.extractfile(tinfo).read()
+            padding = b"\0" * (-len(data) % tarfile.BLOCKSIZE)
+            compressed = gzip_member(header + data + padding)
+            output.write(compressed)
+            index.append(
+                {
+                    "name": tinfo.name,
+                    "offset": offset,
+                    "length": len(compressed),
+                    "header": len(header),
+                    "size": len(data),
+                    "isfile": tinfo.isfile(),
+                }
+            )
+            offset += len(compressed)
+        # end-of-archive marker
+        output.write(gzip_member(b"\0" * (2 * tarfile.BLOCKSIZE)))
+
+    os.replace(seekable_filename + ".tmp", seekable_filename)
+    with open(index_filename + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(index_filename + ".tmp", index_filename)
+    return index
+
+
+def succeeded(line):
+    # "success" comes right after "repo", so a prefix of the line is almost always enough
+    try:
+        return jsonscan.project(line[:4096].decode("utf-8", "surrogatepass"), {"success": True})["success"]
+    except ValueError:
+        return json.loads(line)["success"]
+
+
+def library_lines(contents, libraries):
+    """Start of each line with a list item that is a library's name or starts with it and ".", from one pass over the member per library.
+
+    Only list items can be imports: keys (like the library's name in step5's "data") are followed by ":".
+    """
+
+    starts = set()
+    for library in libraries:
+        # no import name has a quote or backslash in it
+        for match in re.finditer(b'"' + re.escape(library.encode()) + rb'(?:\.[^"\\]*)?"[,\]]', contents):
+            starts.add(contents.rfind(b"\n", 0, match.start()) + 1)
+    return starts
+
+
+def imports_library(data, library):
+    for f in data["files"]:
+        if any(x == library or x.startswith(library + ".") for x in f.get("imports", [])):
+            return True
+    return False
+
+
+def scan_member(member, libraries=("numba",)):
+    """Counts and output lines for one member, with num_total as of each line relative to the member's start."""
+
+    with open(seekable_filename, "rb") as file:
+        file.seek(member["offset"])
+        contents = zlib.decompress(file.read(member["length"]), 31)
+    contents = contents[member["header"] : member["header"] + member["size"]]
+
+    num_total = 0
+    found = []
+    maybe_library = library_lines(contents, libraries)
+    start = 0
+    for line in io.BytesIO(contents):
+        start, line_start = start + len(line), start
+        if line_start not in maybe_library:
+            # no string is a library's name or starts with it and ".", so neither is any import
+            if succeeded(line):
+                num_total += 1
+            continue
+        data = json.loads(line)
+
+        if data["success"]:
+            imported = [x for x in libraries if imports_library(data, x)]
+
+            readme = None
+            has_readme = False
+            if len(imported) != 0:
+                for f in data["files"]:
+                    if f["name"] == "/README.md":
+                        if "same_text_as" in f:
+                            # collect-imports-and-strings.py writes a repeated text only once
+                            f = next(x for x in data["files"] if x["name"] == f["same_text_as"])
+                        has_readme = True
+                        readme = f["text"][0]
+                        break
+
+            num_total += 1
+            for library in imported:
+                found.append((library, num_total, has_readme, json.dumps({"repo": data["repo"], "readme": readme})))
+
+    return num_total, found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=f"Repos in {contents_filename} that import numba (or each of --libraries), and their READMEs."
+    )
+    parser.add_argument("--workers", type=int, default=None, help="default: one per CPU")
+    parser.add_argument("--reindex", action="store_true", help=f"rebuild {seekable_filename} and its index")
+    parser.add_argument(
+        "--libraries", nargs="+", default=["numba"], help="all in one pass, with output in import-<library>.jsonl"
+    )
+    args = parser.parse_args()
+
+    if args.reindex or not os.path.exists(index_filename) or not os.path.exists(seekable_filename):
+        index = build_index()
+    else:
+        with open(index_filename) as file:
+            index = json.load(file)
+    members = [x for x in index if x["isfile"]]
+
+    libraries = tuple(args.libraries)
+    with contextlib.ExitStack() as stack:
+        outputs = {x: stack.enter_context(open(f"import-{x}.jsonl", "w")) for x in libraries}
+
+        num_import = dict.fromkeys(libraries, 0)
+        num_and_has_readme = dict.fromkeys(libraries, 0)
+        num_total = 0
+        with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+            scan = functools.partial(scan_member, libraries=libraries)
+            # in member order, so the output is the same as reading the tarball from start to end
+            for member, (member_total, found) in zip(members, pool.map(scan, members, chunksize=1)):
+                print(f"=== {member['name']} ====================================================")
+                for library, total_in_member, has_readme, line in found:
+                    num_import[library] += 1
+                    if has_readme:
+                        num_and_has_readme[library] += 1
+                    prefix = "" if len(libraries) == 1 else f"{library}: "
+                    print(f"{prefix}{num_import[library]} / {num_total + total_in_member} = {num_import[library] / (num_total + total_in_member)}; and has README: {num_and_has_readme[library]} / {num_import[library]} = {num_and_has_readme[library] / num_import[library]}")
+
+                    outputs[library].write(line)
+                    outputs[library].write("\n")
+                num_total += member_total
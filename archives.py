@@ -0,0 +1,385 @@
+"""Per-repo archives written by step3.py and read by step5.py.
+
+Three layouts are supported:
+
+* ``.tgz``: one self-contained gzipped tarball per repo (the original format).
+* ``.zip``: each member compressed separately, with the central directory as an index, so that
+  a reader can pull out the members it needs and skip the rest without decompressing them.
+* ``.manifest``: a small JSON list of members per repo, with each file's content stored once, by
+  SHA-256, in a shared blob store (``ARCHIVED-BLOBS/ab/cdef...``). Repos that vendor the same
+  files share the blobs.
+
+``open_archive`` returns an object with the parts of the ``tarfile.TarFile`` interface that
+step5.py uses: ``getnames()``, ``extractfile(name)``, and use as a context manager.
+``iter_members`` reads any layout, or a cloned tree that has not been archived yet
+(``DirectoryArchive``), in a single forward pass.
+
+Writers take a ``tarfile.TarInfo`` for each member's metadata (``tarinfo`` makes one from a
+path on disk), so archives can also be converted from one layout to another.
+"""
+
+import hashlib
+import io
+import json
+import os
+import posixpath
+import stat
+import tarfile
+import time
+import zipfile
+import zlib
+
+blob_root = "ARCHIVED-BLOBS"
+
+suffixes = ("tgz", "zip", "manifest")
+
+
+def blob_path(root, digest):
+    return os.path.join(root, digest[:2], digest[2:])
+
+
+def put_blob(root, data):
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(root, digest)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique temporary name: other workers may be writing the same blob right now
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as file:
+            file.write(zlib.compress(data, 6))
+        os.replace(tmp, path)
+    return digest
+
+
+def get_blob(root, digest):
+    with open(blob_path(root, digest), "rb") as file:
+        return zlib.decompress(file.read())
+
+
+class BlobReader:
+    """``read()`` for a manifest member, with the sha256 of its content known without reading it."""
+
+    def __init__(self, root, sha256):
+        self.root = root
+        self.sha256 = sha256
+
+    def __call__(self):
+        return get_blob(self.root, self.sha256)
+
+
+def tarinfo(path, arcname):
+    """TarInfo for a directory, symlink, or regular file on disk (None for anything else)."""
+
+    info = os.lstat(path)
+    out = tarfile.TarInfo(arcname)
+    out.mode = stat.S_IMODE(info.st_mode)
+    out.mtime = int(info.st_mtime)
+    out.uid = info.st_uid
+    out.gid = info.st_gid
+    if stat.S_ISDIR(info.st_mode):
+        out.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(info.st_mode):
+        out.type = tarfile.SYMTYPE
+        out.linkname = os.readlink(path)
+    elif stat.S_ISREG(info.st_mode):
+        out.type = tarfile.REGTYPE
+        out.size = info.st_size
+    else:
+        return None
+    return out
+
+
+class _View:
+    # file-like wrapper so that tarfile can copy straight out of an mmap
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.pos + size
+        out = self.data[self.pos : end]
+        self.pos += len(out)
+        return out
+
+
+class TarWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.archive = tarfile.open(filename + ".tmp", "w:gz", compresslevel=6, format=tarfile.GNU_FORMAT)
+
+    def addmember(self, info, data=None):
+        if info.isreg():
+            info.size = len(data)
+            self.archive.addfile(info, _View(data))
+        else:
+            self.archive.addfile(info)
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def abort(self):
+        self.archive.close()
+        os.remove(self.filename + ".tmp")
+
+
+class ZipWriter:
+    def __init__(self, filename):
+        self.filename = filename
+        self.archive = zipfile.ZipFile(filename + ".tmp", "w", compression=zipfile.ZIP_DEFLATED, compresslevel=6)
+
+    def addmember(self, info, data=None):
+        # file types in the high bits of external_attr, as Info-ZIP does; symlinks store their target
+        member = zipfile.ZipInfo(
+            info.name + ("/" if info.isdir() else ""),
+            max((1980, 1, 1, 0, 0, 0), time.localtime(info.mtime)[:6]),
+        )
+        member.create_system = 3
+        if info.isdir():
+            member.external_attr = ((stat.S_IFDIR | info.mode) << 16) | 0x10
+            self.archive.writestr(member, b"")
+        elif info.issym():
+            member.external_attr = (stat.S_IFLNK | info.mode) << 16
+            self.archive.writestr(member, info.linkname.encode("utf-8", "surrogateescape"))
+        else:
+            member.external_attr = (stat.S_IFREG | info.mode) << 16
+            member.compress_type = zipfile.ZIP_DEFLATED
+            with self.archive.open(member, "w", force_zip64=len(data) >= 2**31) as file:
+                file.write(data)
+
+    def close(self):
+        self.archive.close()
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def abort(self):
+        self.archive.close()
+        os.remove(self.filename + ".tmp")
+
+
+class BlobStoreWriter:
+    def __init__(self, filename, root=blob_root):
+        self.filename = filename
+        self.root = root
+        self.members = []
+
+    def addmember(self, info, data=None):
+        member = {"name": info.name, "mode": info.mode, "mtime": int(info.mtime)}
+        if info.isdir():
+            member["type"] = "dir"
+        elif info.issym():
+            member["type"] = "symlink"
+            member["linkname"] = info.linkname
+        else:
+            member["type"] = "file"
+            member["size"] = len(data)
+            member["sha256"] = put_blob(self.root, data[:])
+        self.members.append(member)
+
+    def close(self):
+        with open(self.filename + ".tmp", "w") as file:
+            json.dump({"members": self.members}, file, separators=(",", ":"))
+        os.replace(self.filename + ".tmp", self.filename)
+
+    def abort(self):
+        pass
+
+
+def writer(filename):
+    if filename.endswith(".manifest"):
+        return BlobStoreWriter(filename)
+    elif filename.endswith(".zip"):
+        return ZipWriter(filename)
+    return TarWriter(filename)
+
+
+class ManifestArchive:
+    def __init__(self, filename, root=blob_root):
+        with open(filename) as file:
+            self.members = json.load(file)["members"]
+        self.root = root
+        self.by_name = {x["name"]: x for x in self.members}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+    def getnames(self):
+        return [x["name"] for x in self.members]
+
+    def extractfile(self, name):
+        member = self.by_name[name]
+        # same as tarfile: follow symlinks inside the archive, KeyError if the target is not in it
+        for _ in range(40):
+            if member["type"] != "symlink":
+                break
+            member = self.by_name[_link_target(member["name"], member["linkname"], True)]
+        else:
+            raise KeyError(name)
+
+        if member["type"] != "file":
+            return None
+        return io.BytesIO(get_blob(self.root, member["sha256"]))
+
+
+def _zip_kind(info):
+    if info.is_dir():
+        return "dir"
+    elif stat.S_ISLNK(info.external_attr >> 16):
+        return "link"
+    return "file"
+
+
+class ZipArchive:
+    def __init__(self, filename):
+        self.archive = zipfile.ZipFile(filename)
+        self.members = [(x.filename.rstrip("/"), _zip_kind(x), x) for x in self.archive.infolist()]
+        self.by_name = {name: (name, kind, x) for name, kind, x in self.members}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.archive.close()
+
+    def getnames(self):
+        return [name for name, _, _ in self.members]
+
+    def linkname(self, info):
+        return self.archive.read(info).decode("utf-8", "surrogateescape")
+
+    def extractfile(self, name):
+        name, kind, info = self.by_name[name]
+        # same as tarfile: follow symlinks inside the archive, KeyError if the target is not in it
+        for _ in range(40):
+            if kind != "link":
+                break
+            name, kind, info = self.by_name[_link_target(name, self.linkname(info), True)]
+        else:
+            raise KeyError(name)
+
+        if kind != "file":
+            return None
+        return self.archive.open(info)
+
+
+def walk_tree(tree):
+    """``(path, name, kind, size)`` for everything in a cloned tree except .git, in archive order."""
+
+    yield tree, posixpath.basename(tree), "dir", 0
+    stack = [tree]
+    while len(stack) != 0:
+        directory = stack.pop()
+        with os.scandir(directory) as entries:
+            entries = sorted(entries, key=lambda x: x.name)
+        subdirs = []
+        for entry in entries:
+            if entry.name == ".git" and directory == tree:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.path, entry.name, "dir", 0
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path, entry.name, "file", entry.stat(follow_symlinks=False).st_size
+            elif entry.is_symlink():
+                yield entry.path, entry.name, "link", 0
+            else:
+                yield entry.path, entry.name, "other", 0
+        stack.extend(reversed(subdirs))
+
+
+class DirectoryArchive:
+    """A cloned working tree, read as though it had been archived, keeping files where ``keep(name, size)``."""
+
+    def __init__(self, tree, keep):
+        self.tree = tree
+        self.keep = keep
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        pass
+
+
+def _read_path(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def open_archive(filename, stream=False):
+    if filename.endswith(".manifest"):
+        return ManifestArchive(filename)
+    elif filename.endswith(".zip"):
+        return ZipArchive(filename)
+    # a stream can only be read forward, once, but never re-decompresses
+    return tarfile.open(filename, "r|*" if stream else "r")
+
+
+def _link_target(name, linkname, symbolic):
+    # resolved the same way as tarfile.TarFile._find_link_target
+    if symbolic:
+        return posixpath.normpath("/".join(filter(None, (posixpath.dirname(name), linkname))))
+    return posixpath.normpath(linkname)
+
+
+def iter_members(archive):
+    """One forward pass over an archive from ``open_archive(filename, stream=True)``.
+
+    Yields ``(name, kind, target, read)``, where ``kind`` is "file", "dir", "link", or "other",
+    ``target`` is the member name a link points to, and ``read()`` returns a file's bytes (it
+    must be called before advancing to the next member). In the indexed layouts, members that
+    are never read are never decompressed. In a manifest, ``read.sha256`` is the file's hash.
+    """
+
+    if isinstance(archive, DirectoryArchive):
+        for path, name, kind, size in walk_tree(archive.tree):
+            if kind == "file":
+                if archive.keep(name, size):
+                    yield path, "file", None, lambda path=path: _read_path(path)
+            elif kind == "link":
+                yield path, "link", _link_target(path, os.readlink(path), True), None
+            elif kind == "dir":
+                yield path, "dir", None, None
+        return
+
+    if isinstance(archive, ManifestArchive):
+        for member in archive.members:
+            name = member["name"]
+            if member["type"] == "file":
+                yield name, "file", None, BlobReader(archive.root, member["sha256"])
+            elif member["type"] == "symlink":
+                yield name, "link", _link_target(name, member["linkname"], True), None
+            else:
+                yield name, "dir", None, None
+        return
+
+    if isinstance(archive, ZipArchive):
+        for name, kind, info in archive.members:
+            if kind == "file":
+                yield name, "file", None, lambda info=info: archive.archive.read(info)
+            elif kind == "link":
+                yield name, "link", _link_target(name, archive.linkname(info), True), None
+            else:
+                yield name, "dir", None, None
+        return
+
+    for info in archive:
+        if info.isreg() or info.type not in tarfile.SUPPORTED_TYPES:
+            yield info.name, "file", None, lambda info=info: archive.extractfile(info).read()
+        elif info.issym() or info.islnk():
+            yield info.name, "link", _link_target(info.name, info.linkname, info.issym()), None
+        elif info.isdir():
+            yield info.name, "dir", None, None
+        else:
+            yield info.name, "other", None, None
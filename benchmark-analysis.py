@@ -0,0 +1,121 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import step5
+import synthetic
+import timing
+
+default_golden = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark-golden.json")
+find_import_numba = os.path.join(os.path.dirname(os.path.abspath(__file__)), "2024-10-30", "find-import-numba.py")
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def canonical(result):
+    # key order is not part of the output's meaning
+    return json.dumps(json.loads(result), sort_keys=True).encode()
+
+
+def analyze_all(filenames, cache_root=None):
+    results = {}
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for filename in filenames:
+            results[filename] = step5.analyze_repo(filename, cache_root)[1]
+    return time.perf_counter() - start, results
+
+
+def compare_golden(golden, outputs):
+    if golden["parameters"] != outputs["parameters"]:
+        print(f"golden output is for {golden['parameters']}, not {outputs['parameters']}: not compared")
+        return True
+    differ = [x for x in golden["repos"] if golden["repos"][x] != outputs["repos"].get(x)]
+    differ += [x for x in outputs["repos"] if x not in golden["repos"]]
+    for name in differ:
+        print(f"DIFFERS: {name}")
+    if golden["import-numba.jsonl"] != outputs["import-numba.jsonl"]:
+        print("DIFFERS: import-numba.jsonl")
+        differ.append("import-numba.jsonl")
+    print(f"golden output: {len(outputs['repos']) + 1 - len(differ)} same, {len(differ)} different")
+    return len(differ) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Throughput of each analysis stage on a synthetic corpus, and a check against golden output."
+    )
+    parser.add_argument("--repos", type=int, default=200)
+    parser.add_argument("--contents", type=int, default=2000, help="repos in numba-dependents-contents.tgz")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--output-bytes", type=int, default=200000, help="size of each notebook image output")
+    parser.add_argument("--cache", action="store_true", help="also time a cold and a warm ANALYSIS-CACHE")
+    parser.add_argument("--golden", default=default_golden, help="digests of the expected output")
+    parser.add_argument("--update-golden", action="store_true", help="write the golden file instead of checking it")
+    args = parser.parse_args()
+    parameters = {"repos": args.repos, "contents": args.contents, "seed": args.seed, "output_bytes": args.output_bytes}
+
+    original = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            filenames = synthetic.make_corpus(args.repos, args.seed, output_bytes=args.output_bytes)
+            synthetic.make_contents("numba-dependents-contents.tgz", args.contents, args.seed)
+            corpus_bytes = sum(os.path.getsize(x) for x in filenames)
+            contents_bytes = os.path.getsize("numba-dependents-contents.tgz")
+            print(
+                f"generated {len(filenames)} repos ({corpus_bytes / 1e6:.1f} MB) and {args.contents} contents "
+                f"({contents_bytes / 1e6:.1f} MB) in {time.perf_counter() - start:.1f} s"
+            )
+
+            seconds, results = analyze_all(filenames)
+            print(f"analyze_repo: {seconds:.2f} s, {len(filenames) / seconds:.1f} repos/s, {corpus_bytes / 1e6 / seconds:.1f} MB/s (compressed)")
+
+            timing.enable()
+            analyze_all(filenames)
+            print(timing.report(timing.take(), num_slowest=3))
+
+            if args.cache:
+                for label in ("cold", "warm"):
+                    seconds, cached = analyze_all(filenames, "ANALYSIS-CACHE")
+                    same = cached == results
+                    print(f"analyze_repo, {label} cache: {seconds:.2f} s, same output: {same}")
+
+            start = time.perf_counter()
+            subprocess.run([sys.executable, find_import_numba], check=True, stdout=subprocess.DEVNULL)
+            seconds = time.perf_counter() - start
+            print(
+                f"find-import-numba.py: {seconds:.2f} s, {args.contents / seconds:.0f} repos/s, "
+                f"{contents_bytes / 1e6 / seconds:.1f} MB/s (compressed)"
+            )
+            with open("import-numba.jsonl", "rb") as file:
+                import_numba = file.read()
+        finally:
+            os.chdir(original)
+
+    outputs = {
+        "parameters": parameters,
+        "repos": {name: digest(canonical(result)) for name, result in results.items()},
+        "import-numba.jsonl": digest(import_numba),
+    }
+    if args.update_golden:
+        with open(args.golden, "w") as file:
+            json.dump(outputs, file, indent=1, sort_keys=True)
+            file.write("\n")
+        print(f"wrote {args.golden}")
+    elif not os.path.exists(args.golden):
+        print(f"no {args.golden} to compare with (make it with --update-golden)")
+    else:
+        with open(args.golden) as file:
+            if not compare_golden(json.load(file), outputs):
+                sys.exit(1)
@@ -0,0 +1,96 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+
+import archives
+import step5
+
+convert = __import__("convert-archives").convert
+
+corpus_dir = "GitHub-numba-user-nonfork-raw-data-1Mcut-imports"
+
+
+def read_needed(filename):
+    # the members that step5.analyze_repo reads; everything else is skipped
+    num_bytes = 0
+    with archives.open_archive(filename, stream=True) as file:
+        for name, kind, target, read in archives.iter_members(file):
+            pieces = name.lower().rsplit(".", 1)
+            if kind == "file" and len(pieces) == 2 and pieces[1] in step5.handlers:
+                num_bytes += len(read())
+    return num_bytes
+
+
+def read_needed_by_name(filename):
+    # the old access pattern: getnames(), then extractfile() by name
+    num_bytes = 0
+    with archives.open_archive(filename) as file:
+        for name in file.getnames():
+            pieces = name.lower().rsplit(".", 1)
+            if len(pieces) == 2 and pieces[1] in step5.handlers:
+                try:
+                    subfile = file.extractfile(name)
+                except KeyError:
+                    continue
+                if subfile is not None:
+                    num_bytes += len(subfile.read())
+    return num_bytes
+
+
+def timed(function, filenames):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [function(x) for x in filenames]
+    return time.perf_counter() - start, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the .tgz and .zip layouts on the same repos.")
+    parser.add_argument("filenames", nargs="+", help=f".tgz files in {corpus_dir}/*/")
+    parser.add_argument("--analyze", action="store_true", help="also time step5.analyze_repo")
+    args = parser.parse_args()
+
+    original = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # analyze_repo takes the repo name from the path, so mirror the corpus layout
+        tgz_files, zip_files = [], []
+        for filename in args.filenames:
+            user, repo = os.path.abspath(filename).split("/")[-2:]
+            os.makedirs(os.path.join(workdir, corpus_dir, user), exist_ok=True)
+            local = f"{corpus_dir}/{user}/{repo}"
+            shutil.copyfile(filename, os.path.join(workdir, local))
+            tgz_files.append(local)
+            zip_files.append(local[: local.rindex(".")] + ".zip")
+
+        os.chdir(workdir)
+        try:
+            start = time.perf_counter()
+            for filename in tgz_files:
+                convert(filename, "zip")
+            print(f"converted {len(tgz_files)} repos in {time.perf_counter() - start:.2f} s")
+
+            tgz_size = sum(os.path.getsize(x) for x in tgz_files)
+            zip_size = sum(os.path.getsize(x) for x in zip_files)
+            print(f"size: tgz {tgz_size / 1e6:.1f} MB, zip {zip_size / 1e6:.1f} MB")
+
+            rows = [
+                ("tgz, by name", read_needed_by_name, tgz_files),
+                ("tgz, one pass", read_needed, tgz_files),
+                ("zip, by name", read_needed_by_name, zip_files),
+                ("zip, one pass", read_needed, zip_files),
+            ]
+            for label, function, filenames in rows:
+                seconds, num_bytes = timed(function, filenames)
+                print(f"read needed members, {label:14s} {seconds:8.3f} s ({sum(num_bytes) / 1e6:.1f} MB)")
+
+            if args.analyze:
+                tgz_seconds, tgz_results = timed(step5.analyze_repo, tgz_files)
+                zip_seconds, zip_results = timed(step5.analyze_repo, zip_files)
+                same = all(a[1] == b[1] for a, b in zip(tgz_results, zip_results))
+                print(f"analyze_repo: tgz {tgz_seconds:.2f} s, zip {zip_seconds:.2f} s, same output: {same}")
+        finally:
+            os.chdir(original)
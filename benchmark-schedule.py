@@ -0,0 +1,56 @@
+import argparse
+import contextlib
+import heapq
+import io
+import os
+import tempfile
+import time
+
+import step5
+import synthetic
+
+def makespan(chunks, seconds, num_workers):
+    # ProcessPoolExecutor hands the next chunk, in submission order, to whichever worker is free first
+    workers = [0.0] * num_workers
+    for chunk in chunks:
+        heapq.heappush(workers, heapq.heappop(workers) + sum(seconds[x] for x in chunk))
+    return max(workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Makespan of step5.py's schedule on a skewed synthetic corpus.")
+    parser.add_argument("--repos", type=int, default=1000)
+    parser.add_argument("--big", type=int, default=4, help="how many of the repos are big")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--shard-size", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=12345)
+    args = parser.parse_args()
+
+    original = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            # small repos of Python files only, and a few big ones that sort last
+            filenames = synthetic.make_corpus(
+                args.repos, args.seed, args.big, num_python=(1, 10), num_notebooks=(0, 0), num_c=(0, 0)
+            )
+
+            # each repo's time, measured once; the makespans are simulated from these
+            seconds = {}
+            with contextlib.redirect_stdout(io.StringIO()):
+                for filename in filenames:
+                    start = time.perf_counter()
+                    step5.analyze_repo(filename)
+                    seconds[filename] = time.perf_counter() - start
+            total = sum(seconds.values())
+            print(f"{len(filenames)} repos, {total:.2f} s of work, largest {max(seconds.values()):.2f} s")
+
+            costs = {x: step5.estimate_cost(x) for x in filenames}
+            in_order = [filenames[i : i + args.shard_size] for i in range(0, len(filenames), args.shard_size)]
+            scheduled = step5.schedule(filenames, costs, args.shard_size, args.workers)
+            bound = max(total / args.workers, max(seconds.values()))
+            print(f"lower bound with {args.workers} workers: {bound:.2f} s")
+            for label, chunks in [("input order", in_order), ("largest first", scheduled)]:
+                print(f"{label:14s} {len(chunks):4d} shards, makespan {makespan(chunks, seconds, args.workers):.2f} s")
+        finally:
+            os.chdir(original)
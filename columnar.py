@@ -0,0 +1,208 @@
+"""step5.py's results as flat tables, in Arrow IPC files that can be memory-mapped.
+
+One directory holds five tables, linked by integer ids (each id is a row number):
+
+* ``repos``: repo, name, num_files
+* ``languages``: repo, language, count (the "other_language" counts)
+* ``files``: file, repo, kind ("python" or "c"), name, suffix, parsed (False if the file could
+  not be parsed), is_c and num_cuda (C and C++ files only)
+* ``imports``: file, repo, module, scope ("top", "nested", "global", or "local"), count
+* ``references``: file, repo, library, reference, count (references to numba, or to each of
+  step5.py's ``--libraries``, in Python files)
+
+Repeated strings are dictionary-encoded. ``read_results(directory)`` memory-maps them all, and
+``table.to_pandas()`` gives a DataFrame with categorical columns, e.g. the C-file table is
+
+    tables = columnar.read_results("output-results.arrow")
+    c_files = tables["files"].filter(pc.equal(tables["files"]["kind"], "c"))
+"""
+
+import array
+import os
+import shutil
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather
+
+table_names = ("repos", "languages", "files", "imports", "references")
+
+
+class _Strings:
+    # dictionary encoding as rows are added: codes here, each distinct string once
+    def __init__(self):
+        self.codes = array.array("i")
+        self.index = {}
+
+    def append(self, value):
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.index)
+        self.codes.append(code)
+
+    def to_arrow(self):
+        return pa.DictionaryArray.from_arrays(_ints(self.codes, pa.int32()), pa.array(list(self.index), pa.string()))
+
+
+def _ints(values, arrow_type):
+    return pa.Array.from_buffers(arrow_type, len(values), [None, pa.py_buffer(values)])
+
+
+def _nullable(values, arrow_type):
+    # -1 stands for null
+    out = _ints(values, arrow_type)
+    return pc.if_else(pc.equal(out, -1), pa.scalar(None, arrow_type), out)
+
+
+class ResultWriter:
+    """Accumulates repos from step5.analyze_members (or its JSON lines) and writes the tables on close."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.repos = {"name": [], "num_files": array.array("q")}
+        self.languages = {"repo": array.array("i"), "language": _Strings(), "count": array.array("q")}
+        self.files = {
+            "repo": array.array("i"),
+            "kind": _Strings(),
+            "name": [],
+            "suffix": _Strings(),
+            "parsed": array.array("b"),
+            "is_c": array.array("b"),
+            "num_cuda": array.array("i"),
+        }
+        self.imports = {
+            "file": array.array("i"),
+            "repo": array.array("i"),
+            "module": _Strings(),
+            "scope": _Strings(),
+            "count": array.array("i"),
+        }
+        self.references = {
+            "file": array.array("i"),
+            "repo": array.array("i"),
+            "library": _Strings(),
+            "reference": _Strings(),
+            "count": array.array("i"),
+        }
+
+    def add(self, repodata):
+        repo = len(self.repos["name"])
+        self.repos["name"].append(repodata["name"])
+        self.repos["num_files"].append(repodata["num_files"])
+
+        for language, count in repodata["other_language"].items():
+            self.languages["repo"].append(repo)
+            self.languages["language"].append(language)
+            self.languages["count"].append(count)
+
+        for kind in ("python", "c"):
+            for entry in repodata[kind]:
+                file = self._add_file(repo, kind, entry)
+                data = entry["data"]
+                if data is None:
+                    continue
+                if kind == "python":
+                    self._add_imports(file, repo, data["top"], "top")
+                    self._add_imports(file, repo, data["nested"], "nested")
+                    # every other key is a library's references
+                    for library, references in data.items():
+                        if library in ("top", "nested"):
+                            continue
+                        for reference, count in references.items():
+                            self.references["file"].append(file)
+                            self.references["repo"].append(repo)
+                            self.references["library"].append(library)
+                            self.references["reference"].append(reference)
+                            self.references["count"].append(count)
+                else:
+                    self._add_imports(file, repo, data["global"], "global")
+                    self._add_imports(file, repo, data["local"], "local")
+
+    def _add_file(self, repo, kind, entry):
+        file = len(self.files["name"])
+        data = entry["data"]
+        self.files["repo"].append(repo)
+        self.files["kind"].append(kind)
+        self.files["name"].append(entry["name"])
+        self.files["suffix"].append(entry["suffix"])
+        self.files["parsed"].append(data is not None)
+        if kind == "c" and data is not None:
+            self.files["is_c"].append(-1 if data["is_c"] is None else data["is_c"])
+            self.files["num_cuda"].append(data["num_cuda"])
+        else:
+            self.files["is_c"].append(-1)
+            self.files["num_cuda"].append(-1)
+        return file
+
+    def _add_imports(self, file, repo, counts, scope):
+        for module, count in counts.items():
+            self.imports["file"].append(file)
+            self.imports["repo"].append(repo)
+            self.imports["module"].append(module)
+            self.imports["scope"].append(scope)
+            self.imports["count"].append(count)
+
+    def tables(self):
+        return {
+            "repos": pa.table(
+                {
+                    "repo": pa.array(range(len(self.repos["name"])), pa.int32()),
+                    "name": pa.array(self.repos["name"], pa.string()),
+                    "num_files": _ints(self.repos["num_files"], pa.int64()),
+                }
+            ),
+            "languages": pa.table(
+                {
+                    "repo": _ints(self.languages["repo"], pa.int32()),
+                    "language": self.languages["language"].to_arrow(),
+                    "count": _ints(self.languages["count"], pa.int64()),
+                }
+            ),
+            "files": pa.table(
+                {
+                    "file": pa.array(range(len(self.files["name"])), pa.int32()),
+                    "repo": _ints(self.files["repo"], pa.int32()),
+                    "kind": self.files["kind"].to_arrow(),
+                    "name": pa.array(self.files["name"], pa.string()),
+                    "suffix": self.files["suffix"].to_arrow(),
+                    "parsed": pc.equal(_ints(self.files["parsed"], pa.int8()), 1),
+                    "is_c": pc.equal(_nullable(self.files["is_c"], pa.int8()), 1),
+                    "num_cuda": _nullable(self.files["num_cuda"], pa.int32()),
+                }
+            ),
+            "imports": pa.table(
+                {
+                    "file": _ints(self.imports["file"], pa.int32()),
+                    "repo": _ints(self.imports["repo"], pa.int32()),
+                    "module": self.imports["module"].to_arrow(),
+                    "scope": self.imports["scope"].to_arrow(),
+                    "count": _ints(self.imports["count"], pa.int32()),
+                }
+            ),
+            "references": pa.table(
+                {
+                    "file": _ints(self.references["file"], pa.int32()),
+                    "repo": _ints(self.references["repo"], pa.int32()),
+                    "library": self.references["library"].to_arrow(),
+                    "reference": self.references["reference"].to_arrow(),
+                    "count": _ints(self.references["count"], pa.int32()),
+                }
+            ),
+        }
+
+    def close(self):
+        # uncompressed, so that reading is a memory map; the directory appears all at once
+        tmp = self.directory + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        for name, table in self.tables().items():
+            pyarrow.feather.write_feather(table, os.path.join(tmp, name + ".arrow"), compression="uncompressed")
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(tmp, self.directory)
+
+
+def read_results(directory):
+    return {
+        name: pyarrow.feather.read_table(os.path.join(directory, name + ".arrow"), memory_map=True)
+        for name in table_names
+    }
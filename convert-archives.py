@@ -0,0 +1,54 @@
+import argparse
+import concurrent.futures
+import copy
+import functools
+import os
+import posixpath
+import tarfile
+
+import archives
+
+
+def convert(filename, archive_format, remove=False):
+    output_filename = filename[: filename.rindex(".")] + "." + archive_format
+    if os.path.exists(output_filename):
+        return filename, "SKIP"
+
+    writer = archives.writer(output_filename)
+    try:
+        with tarfile.open(filename, "r|*") as tar:
+            for info in tar:
+                if info.isreg():
+                    writer.addmember(info, tar.extractfile(info).read())
+                elif info.isdir() or info.issym():
+                    writer.addmember(info)
+                elif info.islnk():
+                    # the other layouts have no hard links; a relative symlink reads the same
+                    link = copy.copy(info)
+                    link.type = tarfile.SYMTYPE
+                    link.linkname = posixpath.relpath(info.linkname, posixpath.dirname(info.name) or ".")
+                    writer.addmember(link)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+    if remove:
+        os.remove(filename)
+    return filename, "GOOD"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert per-repo .tgz archives to another layout.")
+    parser.add_argument("filenames", nargs="+", help=".tgz files written by step3.py")
+    parser.add_argument("--format", choices=[x for x in archives.suffixes if x != "tgz"], default="zip")
+    parser.add_argument("--remove", action="store_true", help="delete each .tgz once it is converted")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    task = functools.partial(convert, archive_format=args.format, remove=args.remove)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for i, (filename, status) in enumerate(executor.map(task, args.filenames, chunksize=16)):
+            print(f"{status:4s} {i + 1}/{len(args.filenames)} {filename}", flush=True)
+
+    print("DONE", flush=True)
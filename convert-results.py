@@ -0,0 +1,22 @@
+import argparse
+import json
+import time
+
+import columnar
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert step5.py's JSON lines into columnar tables.")
+    parser.add_argument("input", nargs="?", default="output-results.jsons")
+    parser.add_argument("--output", default="output-results.arrow", help="directory of Arrow IPC files")
+    args = parser.parse_args()
+
+    start = time.time()
+    writer = columnar.ResultWriter(args.output)
+    with open(args.input) as file:
+        for i, line in enumerate(file):
+            writer.add(json.loads(line))
+            if (i + 1) % 1000 == 0:
+                print(f"{int(time.time() - start)} s: {i + 1} repos", flush=True)
+    writer.close()
+
+    print("DONE", f"({int(time.time() - start)} s)", flush=True)
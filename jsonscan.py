@@ -0,0 +1,168 @@
+"""Reading parts of a JSON document without decoding the rest.
+
+``read_object`` and ``skip_value`` walk a JSON text by position, so that a reader can decode the
+members it wants with ``json`` and step over the others (notebooks.py uses them to skip cell
+outputs). ``project(text, pattern)`` does that for a whole document, given a pattern of the fields
+to keep:
+
+* ``True``: the value, decoded by ``json``;
+* a dict of ``{key: pattern}``: an object with only those keys (any that are missing are left out);
+* a one-item list ``[pattern]``: an array with the pattern applied to each item.
+
+Skipped strings are stepped over with ``str.find`` (and checked with a regex when strict), without
+building Python strings, so skipping a value takes no memory however long its strings are. That is
+only a win when a lot is skipped, or when ``project`` can stop early: per value, Python-level
+scanning is slower than ``json.loads`` decoding everything in C.
+"""
+
+import json
+import re
+
+json_decoder = json.JSONDecoder()
+json_whitespace = re.compile(r"[ \t\n\r]*")
+
+# one token of a value that is skipped (strings are handled separately)
+json_token = re.compile(r"[ \t\n\r]*([\[\]{},:\"]|-?[0-9][0-9.eE+-]*|true|false|null|NaN|-?Infinity)")
+
+# what json.loads rejects inside a string: a control character, or an escape that isn't valid
+# (the first backslash of a run, then pairs, then one that doesn't start a valid escape). Two
+# searches, because one that starts with a literal backslash is much faster than an alternation.
+json_string_control = re.compile(r"[\x00-\x1f]")
+json_string_bad_escape = re.compile(r'\\(?<!\\\\)(?:\\\\)*(?!["\\/bfnrt]|u[0-9a-fA-F]{4})')
+
+
+def _skip_string(text, pos):
+    # pos is just after the opening quote; the closing quote is the first without an odd number of backslashes before it
+    while True:
+        end = text.find('"', pos)
+        if end < 0:
+            raise ValueError(f"unterminated string at {pos}")
+        backslash = end
+        while text[backslash - 1] == "\\":
+            backslash -= 1
+        if (end - backslash) % 2 == 0:
+            return end + 1
+        pos = end + 1
+
+
+def skip_value(text, pos, strict=True):
+    """Position after the value at pos; strict checks strings the way json.loads does."""
+
+    depth = 0
+    while True:
+        token = json_token.match(text, pos)
+        if token is None:
+            raise ValueError(f"not JSON at {pos}")
+        pos = token.end()
+        first = token.group(1)[0]
+        if first == '"':
+            try:
+                end = _skip_string(text, pos)
+            except ValueError:
+                if strict:
+                    json.decoder.scanstring(text, pos)
+                raise
+            if strict and (
+                json_string_bad_escape.search(text, pos, end - 1) is not None
+                or json_string_control.search(text, pos, end - 1) is not None
+            ):
+                # raises json's own error (only a bad string is decoded)
+                json.decoder.scanstring(text, pos)
+            pos = end
+        elif first in "[{":
+            depth += 1
+        elif first in "]}":
+            depth -= 1
+            if depth < 0:
+                raise ValueError(f"unbalanced at {pos}")
+        if depth == 0 and first not in ",:":
+            return pos
+
+
+def expect(text, pos, char):
+    pos = json_whitespace.match(text, pos).end()
+    if text[pos : pos + 1] != char:
+        raise ValueError(f"expected {char!r} at {pos}")
+    return pos + 1
+
+
+def read_object(text, pos, read_member, stop=None):
+    """{"key": value, ...}, with each value read by read_member(text, pos, key) -> (value, pos).
+
+    If stop(out) becomes true, returns (out, None) without reading the rest of the object.
+    """
+
+    out = {}
+    pos = expect(text, pos, "{")
+    pos = json_whitespace.match(text, pos).end()
+    if text[pos : pos + 1] == "}":
+        return out, pos + 1
+    while True:
+        pos = json_whitespace.match(text, pos).end()
+        key, pos = json_decoder.raw_decode(text, pos)
+        if not isinstance(key, str):
+            raise ValueError(f"non-string key at {pos}")
+        pos = expect(text, pos, ":")
+        out[key], pos = read_member(text, json_whitespace.match(text, pos).end(), key)
+        if stop is not None and stop(out):
+            return out, None
+        pos = json_whitespace.match(text, pos).end()
+        if text[pos : pos + 1] == "}":
+            return out, pos + 1
+        pos = expect(text, pos, ",")
+
+
+def read_array(text, pos, read_item):
+    """[item, ...], with each item read by read_item(text, pos) -> (item, pos)."""
+
+    out = []
+    pos = expect(text, pos, "[")
+    pos = json_whitespace.match(text, pos).end()
+    if text[pos : pos + 1] == "]":
+        return out, pos + 1
+    while True:
+        item, pos = read_item(text, json_whitespace.match(text, pos).end())
+        out.append(item)
+        pos = json_whitespace.match(text, pos).end()
+        if text[pos : pos + 1] == "]":
+            return out, pos + 1
+        pos = expect(text, pos, ",")
+
+
+def _project(text, pos, pattern):
+    if pattern is True:
+        return json_decoder.raw_decode(text, pos)
+    elif isinstance(pattern, list):
+        if text[pos : pos + 1] != "[":
+            return json_decoder.raw_decode(text, pos)
+        return read_array(text, pos, lambda text, pos: _project(text, pos, pattern[0]))
+    else:
+        if text[pos : pos + 1] != "{":
+            return json_decoder.raw_decode(text, pos)
+        out, pos = read_object(text, pos, lambda text, pos, key: _read_projected(text, pos, pattern.get(key)))
+        return {k: v for k, v in out.items() if k in pattern}, pos
+
+
+def _read_projected(text, pos, pattern):
+    if pattern is None:
+        return None, skip_value(text, pos, strict=False)
+    return _project(text, pos, pattern)
+
+
+def project(text, pattern):
+    """The parts of the JSON document in text that pattern asks for (see above).
+
+    Returns as soon as a top-level object has all of the pattern's keys, without checking the rest.
+    """
+
+    pos = json_whitespace.match(text, 0).end()
+    if isinstance(pattern, dict) and text[pos : pos + 1] == "{":
+        keys = set(pattern)
+        out, _ = read_object(
+            text,
+            pos,
+            lambda text, pos, key: _read_projected(text, pos, pattern.get(key)),
+            stop=lambda out: keys.issubset(out),
+        )
+        return {k: v for k, v in out.items() if k in pattern}
+    return _project(text, pos, pattern)[0]
@@ -0,0 +1,69 @@
+"""Python source (and markdown) from .ipynb files, for step5.py and 2024-10-30/collect-imports-and-strings.py.
+
+``notebook_source(text)`` returns the same ``jupytext.writes(jupytext.reads(text), fmt="py:percent")``
+text as before, along with the markdown cells. It scans the notebook JSON itself, decoding only the
+cells' types, sources, and metadata. Cell outputs and attachments (often megabytes of base64
+images) are checked the way ``json.loads`` would check them, but never decoded, so they take no
+memory beyond the notebook text. The notebook is not schema-validated. Anything that isn't
+a plain nbformat 4 notebook is read by jupytext, as before.
+"""
+
+import jupytext
+from nbformat.v4.nbjson import JSONReader
+
+import jsonscan
+
+skipped_cell_fields = {"outputs": [], "attachments": {}}
+
+
+def _read_cell_member(text, pos, key):
+    if key in skipped_cell_fields:
+        return type(skipped_cell_fields[key])(), jsonscan.skip_value(text, pos)
+    return jsonscan.json_decoder.raw_decode(text, pos)
+
+
+def _read_cells(text, pos):
+    return jsonscan.read_array(text, pos, lambda text, pos: jsonscan.read_object(text, pos, _read_cell_member))
+
+
+def _read_notebook_member(text, pos, key):
+    if key == "cells":
+        return _read_cells(text, pos)
+    return jsonscan.json_decoder.raw_decode(text, pos)
+
+
+def scan_notebook(text):
+    """The notebook JSON as a dict, with cell outputs and attachments left empty; None if it isn't plain nbformat 4."""
+
+    try:
+        notebook, pos = jsonscan.read_object(text, 0, _read_notebook_member)
+    except ValueError:
+        return None
+    if jsonscan.json_whitespace.match(text, pos).end() != len(text):
+        return None
+
+    if notebook.get("nbformat") != 4 or not isinstance(notebook.get("metadata"), dict):
+        return None
+    cells = notebook.get("cells")
+    if not isinstance(cells, list):
+        return None
+    for cell in cells:
+        if not isinstance(cell, dict) or not isinstance(cell.get("metadata"), dict):
+            return None
+    return notebook
+
+
+def read_notebook(text):
+    notebook = scan_notebook(text)
+    if notebook is None:
+        return jupytext.reads(text)
+    # the same conversion nbformat.reads applies: joins source lines and drops transient metadata
+    return JSONReader().to_notebook(notebook)
+
+
+def notebook_source(text):
+    """(Python source in jupytext's py:percent format, list of markdown cell sources)."""
+
+    notebook = read_notebook(text)
+    markdown = [x["source"] for x in notebook["cells"] if x["cell_type"] == "markdown"]
+    return jupytext.writes(notebook, fmt="py:percent"), markdown
@@ -0,0 +1,283 @@
+"""Everything step5.py and 2024-10-30/collect-imports-and-strings.py take from a Python syntax tree, in one walk.
+
+``extract(syntax_tree, outputs, libraries)`` returns a dict with the requested outputs:
+
+* ``top``, ``nested``: step5.py's import counts (module level and elsewhere);
+* ``references``: references to each of the ``libraries`` (by default, only numba), under the
+  library's name, with the arguments of calls to its ``argument_functions``;
+* ``docstrings``: collect-imports-and-strings.py's docstrings of the module, classes, and
+  functions, in ``ast.walk`` (breadth-first) order;
+* ``imports``: collect-imports-and-strings.py's sorted imported names, with relative imports as
+  ``"." * level + module``.
+
+Only a file that imports one of the libraries, and only if ``references`` are requested, is walked
+in full; otherwise imports and docstrings are all in statements, and only statements are visited.
+"""
+
+import ast
+import functools
+from collections import Counter
+
+default_libraries = ("numba",)
+
+# calls to these are recorded with their arguments (the JIT compilers and kernel constructors)
+argument_functions = {
+    "numba": set(
+        ["numba.jit", "numba.njit", "numba.generated_jit", "numba.vectorize", "numba.guvectorize", "numba.cfunc"]
+    ),
+    "jax": set(["jax.jit", "jax.pmap", "jax.vmap", "jax.checkpoint"]),
+    "cupy": set(["cupy.fuse", "cupy.RawKernel", "cupy.RawModule", "cupy.ElementwiseKernel", "cupy.ReductionKernel"]),
+}
+jit_functions = argument_functions["numba"]
+
+# names of outputs, which can't also be names of libraries
+output_names = ("top", "nested", "references", "docstrings", "imports")
+
+# the only fields that hold statements (Module, compound statements, except handlers, match cases)
+statement_fields = set(["body", "orelse", "handlers", "finalbody", "cases"])
+
+# every ancestor of a statement is one of these, so depth counted in these is depth in the tree
+statement_holders = set(
+    x
+    for x in vars(ast).values()
+    if isinstance(x, type) and issubclass(x, ast.AST) and statement_fields.intersection(x._fields)
+)
+
+# the nodes that get_docstrings looked at (not AsyncFunctionDef)
+docstring_nodes = (ast.FunctionDef, ast.ClassDef, ast.Module)
+
+_decorated = "decorated"
+_called = "called"
+_decorating = "decorating"
+_left = "left"
+
+
+class APIWalker:
+    """Counts imports and references to the libraries, as an ast.NodeVisitor would, with an explicit stack.
+
+    Deeply nested code can't raise RecursionError, and aliases are looked up in a trie of their
+    dotted names, so a name costs the same however many libraries (and aliases) there are. With
+    ``docstrings`` or ``import_names`` (a list and a set), those are collected in the same walk.
+    """
+
+    def __init__(self, library_imports, docstrings=None, import_names=None, argument_functions=jit_functions):
+        self.library_imports = library_imports
+        self.all_imports = Counter()
+        self.all_references = []
+        self.docstrings = docstrings
+        self.import_names = import_names
+        self.argument_functions = argument_functions
+
+        # one level per name in an alias, with (position in library_imports, real name) under None
+        # where an alias ends: the first import that matches wins
+        self.trie = {}
+        for i, (real, alias) in enumerate(library_imports):
+            node = self.trie
+            for name in alias.split("."):
+                node = node.setdefault(name, {})
+            node.setdefault(None, (i, real))
+
+    def walk(self, syntax_tree):
+        references = self.all_references
+        docstrings = self.docstrings
+        depth = 0
+        stack = [syntax_tree]
+        while len(stack) != 0:
+            node = stack.pop()
+            cls = type(node)
+
+            if cls is ast.Name:
+                if type(node.ctx) is ast.Load and node.id in self.trie:
+                    self._check([node.id])
+
+            elif cls is ast.Attribute:
+                # the chain is not descended into, even if its base is not a Name
+                if type(node.ctx) is ast.Load:
+                    name = [node.attr]
+                    node = node.value
+                    while type(node) is ast.Attribute:
+                        name.append(node.attr)
+                        node = node.value
+                    if type(node) is ast.Name and node.id in self.trie:
+                        name.append(node.id)
+                        name.reverse()
+                        self._check(name)
+
+            elif cls is ast.Call:
+                stack.extend(reversed(node.keywords))
+                stack.extend(reversed(node.args))
+                stack.append((_called, node, len(references)))
+                stack.append(node.func)
+
+            elif cls is tuple:
+                marker, node, n = node
+                if marker is _left:
+                    depth -= 1
+                elif marker is _decorating:
+                    stack.append((_decorated, None, len(references)))
+                    stack.append(node)
+                elif n != len(references):
+                    if marker is _decorated:
+                        references[-1] = "@" + references[-1]
+                    elif references[-1] in self.argument_functions:
+                        try:
+                            references[-1] = references[-1] + call_arguments(node)
+                        except RecursionError:
+                            # too deep to unparse: keep the reference without its arguments
+                            pass
+
+            elif cls is ast.FunctionDef:
+                if docstrings is not None:
+                    _add_docstring(docstrings, depth, node)
+                    stack.append((_left, None, 0))
+                    depth += 1
+                stack.extend(reversed(node.body))
+                if node.returns is not None:
+                    stack.append(node.returns)
+                stack.append(node.args)
+                # each decorator is walked between a marker that records the number of references
+                # and one that checks it
+                for x in reversed(node.decorator_list):
+                    stack.append((_decorating, x, 0))
+
+            elif cls is ast.Import:
+                for subnode in node.names:
+                    self.all_imports[subnode.name.split(".")[0]] += 1
+                    if self.import_names is not None:
+                        self.import_names.add(subnode.name)
+
+            elif cls is ast.ImportFrom:
+                if node.level == 0:
+                    self.all_imports[node.module.split(".")[0]] += 1
+                if self.import_names is not None:
+                    self.import_names.add("." * node.level + ("" if node.module is None else node.module))
+
+            else:
+                if docstrings is not None and cls in statement_holders:
+                    if cls is ast.ClassDef or cls is ast.Module:
+                        _add_docstring(docstrings, depth, node)
+                    stack.append((_left, None, 0))
+                    depth += 1
+                stack.extend(reversed(list(ast.iter_child_nodes(node))))
+
+    def _check(self, names):
+        best = None
+        node = self.trie
+        for end, name in enumerate(names, 1):
+            node = node.get(name)
+            if node is None:
+                break
+            found = node.get(None)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found + (end,)
+        if best is not None:
+            self.all_references.append(best[1] + "".join("." + x for x in names[best[2] :]))
+
+
+def _add_docstring(docstrings, depth, node):
+    docstring = ast.get_docstring(node)
+    if docstring:
+        docstrings.append((depth, docstring))
+
+
+def call_arguments(node):
+    # the "(...)" that ast.unparse(node) ends with, without unparsing the function expression
+    if type(node.func) not in (ast.Name, ast.Attribute):
+        unparsed = ast.unparse(node)
+        return unparsed[unparsed.index("(") :]
+    return "(" + ", ".join(ast.unparse(x) for x in node.args + node.keywords) + ")"
+
+
+def walk_statements(syntax_tree, docstrings=None, import_names=None):
+    """What APIWalker counts in all_imports (and collects), visiting statements only (imports can't be in expressions)."""
+
+    all_imports = Counter()
+    depth = 0
+    stack = [syntax_tree]
+    while len(stack) != 0:
+        node = stack.pop()
+        cls = type(node)
+        if cls is ast.Import:
+            for subnode in node.names:
+                all_imports[subnode.name.split(".")[0]] += 1
+                if import_names is not None:
+                    import_names.add(subnode.name)
+        elif cls is ast.ImportFrom:
+            if node.level == 0:
+                all_imports[node.module.split(".")[0]] += 1
+            if import_names is not None:
+                import_names.add("." * node.level + ("" if node.module is None else node.module))
+        elif cls is tuple:
+            depth -= 1
+        else:
+            if docstrings is not None and cls in statement_holders:
+                if isinstance(node, docstring_nodes):
+                    _add_docstring(docstrings, depth, node)
+                stack.append((_left, None, 0))
+                depth += 1
+            # in field order, like the walker, so that the counts are inserted in the same order
+            for field in reversed(node._fields):
+                if field in statement_fields:
+                    stack.extend(reversed(getattr(node, field)))
+    return all_imports
+
+
+@functools.lru_cache()
+def _argument_functions(libraries):
+    return set().union(*(argument_functions.get(x, ()) for x in libraries))
+
+
+def extract(syntax_tree, outputs=("top", "nested", "references"), libraries=default_libraries):
+    assert isinstance(syntax_tree, ast.Module)
+    outputs = set(outputs)
+    libraries = tuple(dict.fromkeys(libraries))
+    assert not any(x in output_names for x in libraries)
+
+    top_imports = Counter()
+    library_imports = []
+    for node in syntax_tree.body:
+        if isinstance(node, ast.Import):
+            for subnode in node.names:
+                name = subnode.name.split(".")[0]
+                top_imports[name] += 1
+                if name in libraries:
+                    asname = subnode.name if subnode.asname is None else subnode.asname
+                    library_imports.append((subnode.name, asname))
+
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            name = node.module.split(".")[0]
+            top_imports[name] += 1
+            if name in libraries:
+                for subname in node.names:
+                    asname = subname.name if subname.asname is None else subname.asname
+                    library_imports.append((node.module + "." + subname.name, asname))
+
+    docstrings = [] if "docstrings" in outputs else None
+    import_names = set() if "imports" in outputs else None
+    all_references = {x: Counter() for x in libraries}
+    if len(library_imports) == 0 or "references" not in outputs:
+        # nothing can refer to the libraries (or it doesn't matter), so only the statements matter
+        all_imports = walk_statements(syntax_tree, docstrings, import_names)
+    else:
+        visitor = APIWalker(library_imports, docstrings, import_names, _argument_functions(libraries))
+        visitor.walk(syntax_tree)
+        all_imports = visitor.all_imports
+        for x in visitor.all_references:
+            # every real name starts with its library's name
+            all_references[x.lstrip("@").split(".")[0]][x] += 1
+
+    out = {}
+    if "top" in outputs:
+        out["top"] = dict(top_imports)
+    if "nested" in outputs:
+        nested_imports = {k: v - top_imports.get(k, 0) for k, v in all_imports.items()}
+        out["nested"] = {k: v for k, v in nested_imports.items() if v != 0}
+    if "references" in outputs:
+        for library in libraries:
+            out[library] = dict(all_references[library])
+    if docstrings is not None:
+        # stable: in preorder within each depth, which is ast.walk's breadth-first order
+        out["docstrings"] = [x for _, x in sorted(docstrings, key=lambda x: x[0])]
+    if import_names is not None:
+        out["imports"] = sorted(import_names)
+    return out
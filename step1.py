@@ -1,48 +1,232 @@
-# from https://stackoverflow.com/a/72241008/1623645
+# originally from https://stackoverflow.com/a/72241008/1623645, now without a browser
 
+import argparse
+import json
+import os
+import random
+import sys
+import threading
 import time
+from urllib.parse import urljoin, urlsplit
 
-import selenium.webdriver
+import requests
 from bs4 import BeautifulSoup
 
-driver = selenium.webdriver.Chrome()
+RATE_LIMITED = (
+    "exceeded a secondary rate limit",
+    "dependents are currently unavailable",
+)
 
-output = open("numba-dependents.txt", "w")
+OUTPUT_NAMES = {"REPOSITORY": "dependents", "PACKAGE": "packages"}
 
-repo = "numba/numba"
-url = 'https://github.com/{}/network/dependents?dependents_after=MjgxMjEwMDkxMzU'.format(repo)
-nextExists = True
-total = 0
-while nextExists:
-    print(f"{time.strftime('%H:%M:%S')}: get {url}")
-    driver.get(url)
-    while (
-        "exceeded a secondary rate limit" in driver.page_source
-        or "dependents are currently unavailable" in driver.page_source
-    ):
-        print(f"{time.strftime('%H:%M:%S')}: wait 1 minute...")
-        time.sleep(60)
-        driver.get(url)
 
-    soup = BeautifulSoup(driver.page_source, "html.parser")
+def log(message):
+    print(f"{time.strftime('%H:%M:%S')}: {message}", flush=True)
+
+
+def parse_page(html):
+    soup = BeautifulSoup(html, "html.parser")
 
     batch = [
         "{}/{}".format(
-            t.find('a', {"data-repository-hovercards-enabled":""}).text,
-            t.find('a', {"data-hovercard-type":"repository"}).text
+            t.find("a", {"data-repository-hovercards-enabled": ""}).text,
+            t.find("a", {"data-hovercard-type": "repository"}).text,
         )
-        for t in soup.findAll("div", {"class": "Box-row"})
+        for t in soup.find_all("div", {"class": "Box-row"})
     ]
-    total += len(batch)
-    print(f"{time.strftime('%H:%M:%S')}: found {len(batch)} (running total: {total})")
-    output.write("\n".join(batch))
-    output.write("\n")
-    output.flush()
-    nextExists = False
-    for u in soup.find("div", {"class":"paginate-container"}).findAll('a'):
-        if u.text == "Next":
-            nextExists = True
-            url = u["href"]
-    time.sleep(1)
-
-print("{time.strftime('%H:%M:%S')}: DONE")
+
+    next_href = None
+    paginate = soup.find("div", {"class": "paginate-container"})
+    if paginate is not None:
+        for u in paginate.find_all("a"):
+            if u.text == "Next":
+                next_href = u["href"]
+
+    return batch, next_href
+
+
+class Backoff:
+    """Adaptive delay between requests: grows on rate limits, decays on success."""
+
+    def __init__(self, delay=1.0, minimum=0.5, maximum=900.0):
+        self.delay = delay
+        self.minimum = minimum
+        self.maximum = maximum
+        self.failures = 0
+
+    def success(self):
+        self.failures = 0
+        self.delay = max(self.minimum, self.delay * 0.9)
+        return self.delay
+
+    def failure(self, response=None):
+        self.failures += 1
+        self.delay = min(self.maximum, self.delay * 1.5)
+
+        wait = None
+        if response is not None:
+            wait = retry_after(response)
+        if wait is None:
+            wait = min(self.maximum, 5 * 2 ** (self.failures - 1))
+        return wait * random.uniform(1.0, 1.25)
+
+
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is not None:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            return max(0.0, float(response.headers["X-RateLimit-Reset"]) - time.time())
+        except (KeyError, ValueError):
+            pass
+
+    return None
+
+
+def is_rate_limited(response):
+    # 429 and any server error are worth waiting out; other errors (e.g. 404) are not
+    return response.status_code == 429 or response.status_code >= 500 or any(
+        x in response.text for x in RATE_LIMITED
+    )
+
+
+def load_checkpoint(checkpoint_filename):
+    try:
+        with open(checkpoint_filename) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(checkpoint_filename, checkpoint):
+    with open(checkpoint_filename + ".tmp", "w") as file:
+        json.dump(checkpoint, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(checkpoint_filename + ".tmp", checkpoint_filename)
+
+
+def crawl(base_url, repo, dependent_type, output_filename, checkpoint_filename, after=None, delay=1.0):
+    seen = set()
+    try:
+        with open(output_filename) as file:
+            seen.update(x.rstrip("\n") for x in file if x.strip() != "")
+    except FileNotFoundError:
+        pass
+
+    checkpoint = load_checkpoint(checkpoint_filename)
+    if checkpoint is not None and checkpoint["url"] is None:
+        log(f"{output_filename} already complete ({len(seen)} repos)")
+        return len(seen)
+
+    if checkpoint is not None:
+        url = base_url + checkpoint["url"]
+        log(f"resuming {output_filename} from checkpoint ({len(seen)} repos so far)")
+    else:
+        url = f"{base_url}/{repo}/network/dependents?dependent_type={dependent_type}"
+        if after is not None:
+            url += f"&dependents_after={after}"
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "numba-usage-stats (dependents crawler)"
+    backoff = Backoff(delay=delay)
+
+    with open(output_filename, "a") as output:
+        while url is not None:
+            log(f"get {url}")
+            try:
+                response = session.get(url, timeout=60)
+            except requests.RequestException as err:
+                wait = backoff.failure()
+                log(f"{type(err).__name__}, wait {wait:.0f} seconds...")
+                time.sleep(wait)
+                continue
+
+            if is_rate_limited(response):
+                wait = backoff.failure(response)
+                log(f"rate limited ({response.status_code}), wait {wait:.0f} seconds...")
+                time.sleep(wait)
+                continue
+            response.raise_for_status()
+
+            batch, next_href = parse_page(response.text)
+            fresh = [x for x in dict.fromkeys(batch) if x not in seen]
+            seen.update(fresh)
+            log(f"found {len(batch)}, {len(fresh)} new (running total: {len(seen)})")
+            output.write("".join(x + "\n" for x in fresh))
+            output.flush()
+            os.fsync(output.fileno())
+
+            if next_href is None:
+                url = None
+                save_checkpoint(checkpoint_filename, {"url": None})
+            else:
+                # keep the path and cursor, but stay on base_url (so that recorded pages work)
+                parts = urlsplit(urljoin(url, next_href))
+                path = parts.path + ("?" + parts.query if parts.query else "")
+                url = base_url + path
+                save_checkpoint(checkpoint_filename, {"url": path})
+
+            time.sleep(backoff.success())
+
+    log(f"DONE {output_filename} ({len(seen)} repos)")
+    return len(seen)
+
+
+def crawl_thread(failures, base_url, repo, dependent_type, output_filename, *args):
+    # an exception would otherwise end only this thread, and the process would still exit 0
+    try:
+        crawl(base_url, repo, dependent_type, output_filename, *args)
+    except Exception as err:
+        log(f"FAILED {output_filename}: {type(err).__name__}: {err} (run again to resume)")
+        failures.append((output_filename, err))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scrape GitHub's dependents graph.")
+    parser.add_argument("--repo", default="numba/numba")
+    parser.add_argument("--base-url", default="https://github.com")
+    parser.add_argument(
+        "--type",
+        nargs="+",
+        choices=sorted(OUTPUT_NAMES),
+        default=["REPOSITORY"],
+        help="dependent types to crawl; each one is crawled concurrently",
+    )
+    parser.add_argument("--after", default=None, help="dependents_after cursor to start from")
+    parser.add_argument("--delay", type=float, default=1.0, help="initial delay between pages")
+    args = parser.parse_args()
+
+    prefix = args.repo.split("/")[-1]
+    threads = []
+    failures = []
+    for dependent_type in args.type:
+        output_filename = f"{prefix}-{OUTPUT_NAMES[dependent_type]}.txt"
+        thread = threading.Thread(
+            target=crawl_thread,
+            args=(
+                failures,
+                args.base_url.rstrip("/"),
+                args.repo,
+                dependent_type,
+                output_filename,
+                output_filename + ".checkpoint",
+                args.after,
+                args.delay,
+            ),
+        )
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if len(failures) != 0:
+        log(f"FAILED ({len(failures)} of {len(threads)} crawls)")
+        sys.exit(1)
+    log("DONE")
@@ -1,181 +1,469 @@
+import argparse
+import collections
+import functools
+import heapq
+import json
+import mmap
 import os
+import re
+import shutil
+import signal
 import subprocess
+import tempfile
+import time
 import concurrent.futures
 
+import archives
+import jsonscan
 
-def task(reponame):
-    if os.path.exists(f"ARCHIVED-REPOS/{reponame}.tgz"):
-        return
+# files larger than this are dropped unless they have one of these suffixes (case-sensitive, as in find -name)
+size_cut = 1024 * 1024
+interesting_suffixes = set(
+    [
+        "py", "PY", "ipynb", "IPYNB",
+        "c", "cc", "cpp", "cp", "cxx", "c++", "C", "CC", "CPP", "CP", "CXX", "C++",
+        "h", "hpp", "hp", "hh", "H", "HPP", "HP", "HH",
+        "cu", "cuh", "CU", "CUH",
+    ]
+)
+
+grep_words = (b"numba",)
+
+
+@functools.lru_cache()
+def grep_pattern_for(words):
+    return re.compile(rb"\b(?:" + rb"|".join(re.escape(x) for x in words) + rb")\b")
+
+
+url_template = "https://github.com/{}.git"
+
+
+def keep_file(filename, size):
+    if size <= size_cut:
+        return True
+    pieces = filename.rsplit(".", 1)
+    return len(pieces) == 2 and pieces[1] in interesting_suffixes
+
+
+def grep_lines(path, data, words=grep_words):
+    # same output as "grep -i -r '\bnumba\b'" (or "grep -i -r -E '\b(numba|jax)\b'" for more words, all
+    # lowercase): one "path:line" per matching line, binary files skipped
+    if data.find(b"\x00") != -1:
+        return []
+    # bytes.lower is ASCII-only, so offsets in the lowered copy are offsets in the file
+    lowered = data[:].lower()
+    if all(lowered.find(word) == -1 for word in words):
+        return []
+    pattern = grep_pattern_for(words)
+    out = []
+    match = pattern.search(lowered)
+    while match is not None:
+        start = data.rfind(b"\n", 0, match.start()) + 1
+        end = data.find(b"\n", match.end())
+        if end == -1:
+            end = len(data)
+        out.append(path + b":" + data[start:end] + b"\n")
+        match = pattern.search(lowered, end)
+    return out
 
+
+def read_file(path, size):
+    if size == 0:
+        return b""
+    with open(path, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def archive_tree(tree, archive_filename, grep_filename, grep_words=grep_words):
+    """One walk over a cloned tree: grep, apply the size/suffix cut, and stream into the archive.
+
+    Either filename can be None to skip that output; returns the grep lines.
+    """
+
+    grep_output = []
+    archive = None if archive_filename is None else archives.writer(archive_filename)
     try:
-        subprocess.run(
-            [
-                "git",
-                "clone",
-                "--depth",
-                "1",
-                f"https://github.com/{reponame}.git",
-                f"REPO/{reponame}",
-                "--quiet",
-            ],
-            check=True,
-            env={"GIT_TERMINAL_PROMPT": "0"},
-        )
-        subprocess.run(
-            [
-                "mkdir",
-                "-p",
-                f"ARCHIVED-REPOS/{reponame.split('/')[0]}",
-            ],
-            check=True,
-        )
-        grep = subprocess.run(
-            [
-                "grep",
-                "-i",
-                "-r",
-                r"\bnumba\b",
-                f"REPO/{reponame}/",
-            ],
-            capture_output=True,
-        )
-        with open(f"ARCHIVED-REPOS/{reponame}.grep", "wb") as file:
-            file.write(grep.stdout)
-        subprocess.run(
-            [
-                "rm",
-                "-rf",
-                f"REPO/{reponame}/.git",
-            ],
-            check=True,
+        for path, name, kind, size in archives.walk_tree(tree):
+            if kind == "file":
+                data = read_file(path, size)
+                try:
+                    grep_output.extend(grep_lines(os.fsencode(path), data, grep_words))
+                    if archive is not None and keep_file(name, size):
+                        archive.addmember(archives.tarinfo(path, path), data)
+                finally:
+                    if isinstance(data, mmap.mmap):
+                        data.close()
+            elif archive is not None:
+                info = archives.tarinfo(path, path)
+                if info is not None:
+                    archive.addmember(info)
+
+        if grep_filename is not None:
+            with open(grep_filename, "wb") as file:
+                file.writelines(grep_output)
+    except BaseException:
+        if archive is not None:
+            archive.abort()
+        raise
+    if archive is not None:
+        archive.close()
+    return grep_output
+
+
+class CloneTimeout(Exception):
+    pass
+
+
+class CloneTooBig(Exception):
+    pass
+
+
+def tree_size(path):
+    total = 0
+    stack = [path]
+    while len(stack) != 0:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def run_git(command, destination, started, deadline=None, max_bytes=None, poll=0.5):
+    # own session, so that a kill also reaches git-remote-https and index-pack
+    with tempfile.TemporaryFile() as stdout:
+        process = subprocess.Popen(
+            command, stdout=stdout, env={"GIT_TERMINAL_PROMPT": "0"}, start_new_session=True
         )
-        subprocess.run(
-            [
-                "find",
-                f"REPO/{reponame}/",
-                "-type",
-                "f",
-                "-not",
-                "(",
-                "-name",
-                '"*.py"',
-                "-o",
-                "-name",
-                '"*.PY"',
-                "-o",
-                "-name",
-                '"*.ipynb"',
-                "-o",
-                "-name",
-                '"*.IPYNB"',
-                "-o",
-                "-name",
-                '"*.c"',
-                "-o",
-                "-name",
-                '"*.cc"',
-                "-o",
-                "-name",
-                '"*.cpp"',
-                "-o",
-                "-name",
-                '"*.cp"',
-                "-o",
-                "-name",
-                '"*.cxx"',
-                "-o",
-                "-name",
-                '"*.c++"',
-                "-o",
-                "-name",
-                '"*.C"',
-                "-o",
-                "-name",
-                '"*.CC"',
-                "-o",
-                "-name",
-                '"*.CPP"',
-                "-o",
-                "-name",
-                '"*.CP"',
-                "-o",
-                "-name",
-                '"*.CXX"',
-                "-o",
-                "-name",
-                '"*.C++"',
-                "-o",
-                "-name",
-                '"*.h"',
-                "-o",
-                "-name",
-                '"*.hpp"',
-                "-o",
-                "-name",
-                '"*.hp"',
-                "-o",
-                "-name",
-                '"*.hh"',
-                "-o",
-                "-name",
-                '"*.H"',
-                "-o",
-                "-name",
-                '"*.HPP"',
-                "-o",
-                "-name",
-                '"*.HP"',
-                "-o",
-                "-name",
-                '"*.HH"',
-                "-o",
-                "-name",
-                '"*.cu"',
-                "-o",
-                "-name",
-                '"*.cuh"',
-                "-o",
-                "-name",
-                '"*.CU"',
-                "-o",
-                "-name",
-                '"*.CUH"',
-                ")",
-                "-size",
-                "+1M",
-                "-delete",
-            ],
-            check=True,
+        try:
+            while True:
+                try:
+                    returncode = process.wait(timeout=poll)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if deadline is not None and time.monotonic() - started > deadline:
+                    raise CloneTimeout(f"clone took longer than {deadline} seconds")
+                if max_bytes is not None and tree_size(destination) > max_bytes:
+                    raise CloneTooBig(f"clone grew past {max_bytes} bytes")
+        except BaseException:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+            raise
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        stdout.seek(0)
+        return stdout.read()
+
+
+def clone(reponame, destination, url_template=url_template, deadline=None, max_bytes=None, partial=False):
+    started = time.monotonic()
+    limits = (destination, started, deadline, max_bytes)
+
+    if not partial:
+        run_git(
+            ["git", "clone", "--depth", "1", url_template.format(reponame), destination, "--quiet"],
+            *limits,
         )
-        subprocess.run(
-            [
-                "tar",
-                "-czf",
-                f"ARCHIVED-REPOS/{reponame}.tgz",
-                f"REPO/{reponame}/",
-            ],
-            check=True,
+        return
+
+    # blobs bigger than size_cut are never sent (blob:limit=n omits sizes >= n)
+    run_git(
+        [
+            "git",
+            "clone",
+            "--depth",
+            "1",
+            f"--filter=blob:limit={size_cut + 1}",
+            "--no-checkout",
+            url_template.format(reponame),
+            destination,
+            "--quiet",
+        ],
+        *limits,
+    )
+
+    # the blobs that were held back are exactly the files over size_cut
+    missing = set(
+        line[1:].decode()
+        for line in run_git(
+            ["git", "-C", destination, "rev-list", "--objects", "--missing=print", "HEAD"], *limits
+        ).splitlines()
+        if line.startswith(b"?")
+    )
+    dropped = []
+    if len(missing) != 0:
+        for line in run_git(["git", "-C", destination, "ls-tree", "-r", "-z", "HEAD"], *limits).split(b"\0"):
+            if line == b"":
+                continue
+            meta, path = line.split(b"\t", 1)
+            _, kind, oid = meta.split()
+            path = os.fsdecode(path)
+            if kind == b"blob" and oid.decode() in missing and not keep_file(path.rsplit("/", 1)[-1], size_cut + 1):
+                dropped.append(path)
+
+    if len(dropped) != 0:
+        # sparse checkout of everything except the dropped files; the big wanted files are fetched on demand
+        patterns = "/*\n" + "".join("!/" + glob_escape(path) + "\n" for path in dropped)
+        with open(f"{destination}/.git/info/sparse-checkout", "w") as file:
+            file.write(patterns)
+        run_git(["git", "-C", destination, "config", "core.sparseCheckout", "true"], *limits)
+        run_git(["git", "-C", destination, "config", "core.sparseCheckoutCone", "false"], *limits)
+
+    run_git(["git", "-C", destination, "checkout", "--quiet", "HEAD"], *limits)
+
+    # a full checkout would still have the directories that held only dropped files
+    for path in dropped:
+        os.makedirs(os.path.join(destination, os.path.dirname(path)), exist_ok=True)
+
+
+def glob_escape(path):
+    return "".join("\\" + c if c in "*?[]!#\\" else c for c in path)
+
+
+def task(
+    reponame,
+    url_template=url_template,
+    deadline=None,
+    max_bytes=None,
+    partial=False,
+    archive_format="tgz",
+    analyze=False,
+    libraries=("numba",),
+):
+    """Clone and archive one repo; with analyze, also select and analyze it as steps 4 and 5 would.
+
+    Grep, selection, and analysis are for all of the ``libraries``. Returns (status, message,
+    result), where result is a step5 JSON line, "" if the repo does not import any of them, or
+    None if it wasn't analyzed.
+    """
+
+    archive_filename = None if archive_format is None else f"ARCHIVED-REPOS/{reponame}.{archive_format}"
+    if not analyze and os.path.exists(archive_filename):
+        return "SKIP", None, None
+
+    tree = f"REPO/{reponame}"
+    result = None
+    try:
+        clone(reponame, tree, url_template, deadline, max_bytes, partial)
+        if archive_filename is not None:
+            os.makedirs(f"ARCHIVED-REPOS/{reponame.split('/')[0]}", exist_ok=True)
+        grep_output = archive_tree(
+            tree,
+            archive_filename,
+            None if archive_filename is None else f"ARCHIVED-REPOS/{reponame}.grep",
+            tuple(x.lower().encode() for x in libraries),
         )
+        if analyze:
+            # only here, so that cloning and archiving don't need the analysis's dependencies
+            import step4
+            import step5
+
+            matcher = step4.matcher_for(tuple(libraries))
+            if any(matcher.search(line) is not None for line in grep_output):
+                step5.configure_python(libraries)
+                repodata = step5.analyze_members(reponame, lambda: archives.DirectoryArchive(tree, keep_file))
+                result = json.dumps(repodata, ensure_ascii=True, allow_nan=False, separators=(",", ":")) + "\n"
+            else:
+                result = ""
+    except CloneTimeout as err:
+        status, message = "TIMEOUT", str(err)
+    except CloneTooBig as err:
+        status, message = "TOOBIG", str(err)
     except Exception as err:
-        print("BAD ", reponame, repr(err), str(err), flush=True)
+        status, message = "BAD", f"{err!r} {err}"
     else:
-        print("GOOD", reponame, flush=True)
+        status, message = "GOOD", None
     finally:
-        subprocess.run(
-            [
-                "rm",
-                "-rf",
-                f"REPO/{reponame}/",
-            ]
-        )
+        shutil.rmtree(tree, ignore_errors=True)
+
+    if message is None:
+        print(f"{status:4s}", reponame, flush=True)
+    else:
+        print(f"{status:4s}", reponame, message, flush=True)
+    return status, message, result
+
+
+# TOOBIG is deterministic, so there is no point in trying again
+retryable = ("BAD", "TIMEOUT")
+
+
+def run(reponames, workers, attempts=3, backoff=60.0, on_result=None, failed=None, **options):
+    """Keep all workers busy; failed clones go back in line after an exponential backoff.
+
+    ``on_result(reponame, result)`` is called in this process for each analyzed repo. Repos that
+    failed for good are appended to ``failed`` (a new list if None), which is returned.
+    """
+
+    ready = collections.deque((reponame, 0) for reponame in reponames)
+    waiting = []
+    running = {}
+    if failed is None:
+        failed = []
 
+    def finish(future):
+        reponame, attempt = running.pop(future)
+        try:
+            status, message, result = future.result()
+        except Exception as err:
+            status, message, result = "BAD", f"{err!r} {err}", None
 
-reponames = []
-with open("non-fork.txt") as file:
-    for reponame in file:
-        reponames.append(reponame.rstrip())
+        if on_result is not None and result is not None:
+            on_result(reponame, result)
 
-with concurrent.futures.ProcessPoolExecutor(max_workers=24) as executor:
-    executor.map(task, reponames)
+        if status in retryable and attempt + 1 < attempts:
+            retry_at = time.monotonic() + backoff * 2**attempt
+            heapq.heappush(waiting, (retry_at, reponame, attempt + 1))
+        elif status not in ("GOOD", "SKIP"):
+            failed.append((reponame, status, message))
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    try:
+        while len(ready) != 0 or len(waiting) != 0 or len(running) != 0:
+            while len(waiting) != 0 and waiting[0][0] <= time.monotonic():
+                _, reponame, attempt = heapq.heappop(waiting)
+                ready.append((reponame, attempt))
+
+            while len(ready) != 0 and len(running) < workers:
+                reponame, attempt = ready.popleft()
+                running[executor.submit(task, reponame, **options)] = (reponame, attempt)
+
+            timeout = None if len(waiting) == 0 else max(0.0, waiting[0][0] - time.monotonic())
+            if len(running) == 0:
+                time.sleep(timeout)
+                continue
+
+            done, _ = concurrent.futures.wait(
+                running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            broken = any(isinstance(x.exception(), concurrent.futures.process.BrokenProcessPool) for x in done)
+            for future in done:
+                finish(future)
+
+            if broken:
+                # a worker died (killed for using too much memory, or a crash in native code), which
+                # fails every running repo as BAD, to be retried like any other; the pool can't take
+                # new work, so it is replaced
+                for future in concurrent.futures.wait(running)[0]:
+                    finish(future)
+                executor.shutdown(wait=True)
+                print("replacing the process pool after a worker died", flush=True)
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    finally:
+        executor.shutdown(wait=True)
+
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clone, grep, and archive every repo.")
+    parser.add_argument("--input", default="non-fork.txt")
+    parser.add_argument("--workers", type=int, default=24)
+    parser.add_argument("--url-template", default=url_template, help="e.g. /path/to/bare/{}.git")
+    parser.add_argument("--deadline", type=float, default=1800, help="seconds per clone")
+    parser.add_argument("--max-size", type=float, default=4000, help="MB per clone")
+    parser.add_argument(
+        "--partial-clone",
+        action="store_true",
+        help="never download non-source blobs over the size cut (needs a server with partial clone)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=archives.suffixes,
+        default="tgz",
+        help="zip: indexed, per-member compression; manifest: store each unique file once in ARCHIVED-BLOBS",
+    )
+    parser.add_argument(
+        "--analyze",
+        action="store_true",
+        help="run step 4's selection and step 5's analysis on each clone, appending to output-results.jsons",
+    )
+    parser.add_argument("--keep-archives", action="store_true", help="with --analyze, also write the archives")
+    parser.add_argument(
+        "--libraries",
+        nargs="+",
+        default=["numba"],
+        help="grep for (and with --analyze, select and analyze) all of these in one pass",
+    )
+    parser.add_argument("--attempts", type=int, default=3)
+    parser.add_argument("--backoff", type=float, default=60, help="seconds before the first retry")
+    parser.add_argument("--failed", default="failed.txt", help="repos that could not be archived")
+    args = parser.parse_args()
+
+    reponames = []
+    with open(args.input) as file:
+        for reponame in file:
+            reponames.append(reponame.rstrip())
+
+    on_result = None
+    if args.analyze:
+        # streamed.txt records every analyzed repo (YES if it imports a library), so a restart skips them
+        done = set()
+        try:
+            with open("streamed.txt") as file:
+                done.update(line.split("\t")[0] for line in file)
+        except FileNotFoundError:
+            pass
+        # a restart between the two writes in on_result leaves a repo in output-results.jsons but not
+        # in streamed.txt: it's done, too, so that it isn't appended again (and a cut-off line is removed)
+        try:
+            with open("output-results.jsons", "rb+") as file:
+                complete = 0
+                for line in file:
+                    if not line.endswith(b"\n"):
+                        break
+                    # "name" is the first key, so the rest of the line isn't decoded
+                    done.add(jsonscan.project(line.decode("utf-8"), {"name": True})["name"])
+                    complete += len(line)
+                file.truncate(complete)
+        except FileNotFoundError:
+            pass
+        reponames = [x for x in reponames if x not in done]
+
+        streamed = open("streamed.txt", "a")
+        results = open("output-results.jsons", "a")
+
+        def on_result(reponame, result):
+            # results first, so that a crash in between never loses a repo (the restart finds it there)
+            if result != "":
+                results.write(result)
+                results.flush()
+            streamed.write(f"{reponame}\t{'YES' if result != '' else 'NO'}\n")
+            streamed.flush()
+
+    failed = []
+    try:
+        run(
+            reponames,
+            args.workers,
+            attempts=args.attempts,
+            backoff=args.backoff,
+            on_result=on_result,
+            failed=failed,
+            url_template=args.url_template,
+            deadline=args.deadline,
+            max_bytes=int(args.max_size * 1024 * 1024),
+            partial=args.partial_clone,
+            archive_format=None if args.analyze and not args.keep_archives else args.format,
+            analyze=args.analyze,
+            libraries=tuple(args.libraries),
+        )
+    finally:
+        # even if interrupted: what failed so far
+        with open(args.failed, "w") as file:
+            for reponame, status, message in failed:
+                file.write(f"{reponame}\t{status}\t{message}\n")
 
-print("DONE", flush=True)
+    print("DONE", f"({len(failed)} failed)", flush=True)
@@ -1,34 +1,100 @@
-import time
-import os
-import re
+import argparse
+import concurrent.futures
+import functools
 import glob
 import mmap
+import os
+import re
+import time
+
+import archives
+
+
+@functools.lru_cache()
+def matcher_for(libraries):
+    # same as matching line by line: [^\S\n] is \s without the newline, so a match can't span lines
+    names = rb"(?:" + rb"|".join(re.escape(x.encode()) for x in libraries) + rb")"
+    return re.compile(
+        rb"\b(import[^\S\n]+([A-Za-z_][A-Za-z_0-9]*[^\S\n]*,[^\S\n]*)*"
+        + names
+        + rb"|from[^\S\n]+"
+        + names
+        + rb"[^\S\n]+import)\b"
+    )
+
+
+matcher = matcher_for(("numba",))
 
-matcher = re.compile(
-    r"\b(import\s+([A-Za-z_][A-Za-z_0-9]*\s*,\s*)*numba|from\s+numba\s+import)\b"
-)
+# the list of selected archives, which step5.py reads by default
+selected_filename = "GitHub-numba-user-nonfork-raw-data-1Mcut-imports.txt"
 
-filenames = glob.glob("GitHub-numba-user-nonfork-raw-data-1Mcut/*/*.grep")
 
-for i, filename in enumerate(filenames):
-    print(
-        f"{time.strftime('%H:%M:%S')} {i:5d}/{len(filenames):5d} {filename[:-5]}",
-        end="",
-        flush=True,
+def scan(filename, matcher=matcher):
+    with open(filename, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return matcher.search(data) is not None
+
+
+def archive_for(grep_filename):
+    for suffix in archives.suffixes:
+        filename = grep_filename[:-4] + suffix
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def link(filename, source_dir, target_dir):
+    topath = os.path.join(target_dir, os.path.relpath(filename, source_dir))
+    os.makedirs(os.path.dirname(topath), exist_ok=True)
+    try:
+        os.link(filename, topath)
+    except FileExistsError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select the repos that import numba (or any of --libraries).")
+    parser.add_argument("--input-dir", default="GitHub-numba-user-nonfork-raw-data-1Mcut")
+    parser.add_argument("--output", default=selected_filename)
+    parser.add_argument(
+        "--link-dir",
+        default=None,
+        help="also hard-link the selected archives and grep files here (e.g. ...-1Mcut-imports)",
     )
-    with open(filename) as file:
-        for line in file:
-            if matcher.search(line) is not None:
-                frompath = filename[:-4]
-                topath = "/".join(frompath.split("/")[:-1]).replace(
-                    "GitHub-numba-user-nonfork-raw-data-1Mcut/",
-                    "GitHub-numba-user-nonfork-raw-data-1Mcut-imports/",
-                )
-                os.system(f"mkdir -p {topath}")
-                os.system(f"mv {frompath}tgz {frompath}grep {topath}")
-                print(" YES")
-                break
-        else:
-            print(" NO")
-
-print("DONE")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--libraries",
+        nargs="+",
+        default=["numba"],
+        help="select repos that import any of these (step 3 must have grepped for all of them)",
+    )
+    args = parser.parse_args()
+
+    filenames = sorted(glob.glob(f"{args.input_dir}/*/*.grep"))
+
+    task = functools.partial(scan, matcher=matcher_for(tuple(args.libraries)))
+
+    selected = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for i, (filename, found) in enumerate(
+            zip(filenames, executor.map(task, filenames, chunksize=64))
+        ):
+            print(
+                f"{time.strftime('%H:%M:%S')} {i:5d}/{len(filenames):5d} {filename[:-5]} {'YES' if found else 'NO'}",
+                flush=True,
+            )
+            if found:
+                archive = archive_for(filename)
+                if archive is not None:
+                    selected.append(archive)
+                    if args.link_dir is not None:
+                        link(archive, args.input_dir, args.link_dir)
+                        link(filename, args.input_dir, args.link_dir)
+
+    with open(args.output + ".tmp", "w") as file:
+        file.writelines(x + "\n" for x in selected)
+    os.replace(args.output + ".tmp", args.output)
+
+    print(f"DONE ({len(selected)} selected)")
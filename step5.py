@@ -1,23 +1,48 @@
 # see https://gist.github.com/jpivarski/001867b9da51a47b93913a0b9809db3a
 
+import argparse
 import concurrent.futures
+import functools
+import hashlib
+import os
+import shutil
+import signal
 import time
 import glob
-import tarfile
 import json
 import ast
 import re
 import gzip
+import zipfile
 from collections import Counter
 
-import jupytext
 import pycparser
 
+import archives
+import notebooks
+import pysource
+import step4
+import timing
+
 c_parser = pycparser.c_parser.CParser()
-c_directive = re.compile("\s*#.*")
-c_include = re.compile("\s*#include [<\"](.*)[>\"]")
+# same matches as "\s*#include ...", without retrying the leading \s* at every whitespace character
+c_include = re.compile("#include [<\"](.*)[>\"]")
 cuda_bracket = re.compile("<<<.*>>>")
 
+# Tokens that pycparser cannot accept anywhere outside a string or character literal: it
+# rejects comments and stray characters in the lexer, and in C, "::", "<<<", extern "C", and
+# these keyword patterns are syntax errors even if the keyword were a typedef name. A file with
+# any of them is not C, so most C++ (and most commented C) is classified without a parse.
+c_not_c_marker = re.compile(
+    r"""//|/\*|[@`\\]|::|<<<|\bextern\s*"C"|\b(?:class|namespace)\s+\w+\s*\{|\btemplate\s*<\s*(?:>|(?:typename|class)\s+\w)|["']"""
+)
+c_literal = re.compile(r""""(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'""")
+
+# opt-in limits on the full parse; a file over either one gets is_c = None (unknown)
+c_fast_path = True
+c_parse_max_bytes = None
+c_parse_max_seconds = None
+
 cpp_suffixes = set(["c", "h", "c++", "cxx", "hxx", "cpp", "hpp", "hp", "cu", "cuh", "cp", "hh", "cc"])
 
 others = {
@@ -58,244 +83,680 @@ others = {
 }
 
 
-jit_functions = set(
-    ["numba.jit", "numba.njit", "numba.generated_jit", "numba.vectorize", "numba.guvectorize", "numba.cfunc"]
-)
+python_libraries = pysource.default_libraries
+
+
+def configure_python(libraries=pysource.default_libraries):
+    global python_libraries
+    python_libraries = tuple(libraries)
+
+
+def analyze_python_source(source):
+    try:
+        with timing.stage("parse", len(source)):
+            syntax_tree = ast.parse(source)
+    except:
+        return None
+    with timing.stage("walk"):
+        return pysource.extract(syntax_tree, libraries=python_libraries)
+
 
-class APIVisitor(ast.NodeVisitor):
-    def __init__(self, numba_imports):
-        self.numba_imports = numba_imports
-        self.all_imports = Counter()
-        self.all_numba_references = []
-
-    def visit_Import(self, node):
-        for subnode in node.names:
-            self.all_imports[subnode.name.split(".")[0]] += 1
-
-    def visit_ImportFrom(self, node):
-        if node.level == 0:
-            self.all_imports[node.module.split(".")[0]] += 1
-
-    def visit_FunctionDef(self, node):
-        for x in node.decorator_list:
-            n = len(self.all_numba_references)
-            self.visit(x)
-            if n != len(self.all_numba_references):
-                self.all_numba_references[-1] = "@" + self.all_numba_references[-1]
-        self.visit(node.args)
-        if node.returns is not None:
-            self.visit(node.returns)
-        for x in node.body:
-            self.visit(x)
-
-    def visit_Call(self, node):
-        n = len(self.all_numba_references)
-        self.visit(node.func)
-        if n != len(self.all_numba_references):
-            if self.all_numba_references[-1] in jit_functions:
-                unparsed = ast.unparse(node)
-                self.all_numba_references[-1] = self.all_numba_references[-1] + unparsed[unparsed.index("("):]
-        for x in node.args:
-            self.visit(x)
-        for x in node.keywords:
-            self.visit(x)
-
-    def visit_Attribute(self, node):
-        if isinstance(node.ctx, ast.Load):
-            name = ()
-            while isinstance(node, ast.Attribute):
-                name = (node.attr,) + name
-                node = node.value
-            if isinstance(node, ast.Name):
-                name = (node.id,) + name
-                self._check(".".join(name))
-
-    def visit_Name(self, node):
-        if isinstance(node.ctx, ast.Load):
-            self._check(node.id)
-
-    def _check(self, name):
-        for real, alias in self.numba_imports:
-            if name == alias or name.startswith(alias + "."):
-                fixed = real + name[len(alias):]
-                self.all_numba_references.append(fixed)
-                break
-
-
-def analyze_python(syntax_tree):
-    assert isinstance(syntax_tree, ast.Module)
-
-    top_imports = Counter()
-    numba_imports = []
-    for node in syntax_tree.body:
-        if isinstance(node, ast.Import):
-            for subnode in node.names:
-                name = subnode.name.split(".")[0]
-                top_imports[name] += 1
-                if name == "numba":
-                    asname = subnode.name if subnode.asname is None else subnode.asname
-                    numba_imports.append((subnode.name, asname))
-
-        elif isinstance(node, ast.ImportFrom) and node.level == 0:
-            name = node.module.split(".")[0]
-            top_imports[name] += 1
-            if name == "numba":
-                for subname in node.names:
-                    asname = subname.name if subname.asname is None else subname.asname
-                    numba_imports.append((node.module + "." + subname.name, asname))
-
-    visitor = APIVisitor(numba_imports)
+def analyze_notebook_source(source):
     try:
-        visitor.visit(syntax_tree)
-    except RecursionError:
+        with timing.stage("notebook", len(source)):
+            text, _ = notebooks.notebook_source(source.decode("utf-8", errors="surrogateescape"))
+        with timing.stage("parse", len(text)):
+            syntax_tree = ast.parse(text)
+    except:
+        return None
+    with timing.stage("walk"):
+        return pysource.extract(syntax_tree, libraries=python_libraries)
+
+
+def strip_directives(text):
+    # the same as re.sub(r"\s*#.*", "", text): each "#" to the end of its line, with the
+    # whitespace before it
+    pieces = []
+    pos = 0
+    while True:
+        start = text.find("#", pos)
+        if start < 0:
+            break
+        pieces.append(text[pos:start].rstrip())
+        pos = text.find("\n", start)
+        if pos < 0:
+            return "".join(pieces)
+    pieces.append(text[pos:])
+    return "".join(pieces)
+
+
+def configure_c(fast_path=True, max_bytes=None, max_seconds=None):
+    global c_fast_path, c_parse_max_bytes, c_parse_max_seconds
+    c_fast_path, c_parse_max_bytes, c_parse_max_seconds = fast_path, max_bytes, max_seconds
+
+
+def configure_worker(fast_path, max_bytes, max_seconds, libraries):
+    configure_c(fast_path, max_bytes, max_seconds)
+    configure_python(libraries)
+
+
+def has_not_c_marker(text):
+    # stops at the first marker, which is usually a comment near the top of the file
+    pos = 0
+    while True:
+        found = c_not_c_marker.search(text, pos)
+        if found is None:
+            return False
+        if found.group() not in ("\"", "'"):
+            return True
+        # skip over literals; an unterminated one is a lexer error, so it counts too
+        literal = c_literal.match(text, found.start())
+        if literal is None:
+            return True
+        pos = literal.end()
+
+
+class CParseTimeout(Exception):
+    pass
+
+
+def _c_parse_timeout(signum, frame):
+    raise CParseTimeout
+
+
+def parse_is_c(text, subfilename):
+    if c_parse_max_bytes is not None and len(text) > c_parse_max_bytes:
         return None
 
-    nested_imports = {k: v - top_imports.get(k, 0) for k, v in visitor.all_imports.items()}
-    nested_imports = {k: v for k, v in nested_imports.items() if v != 0}
+    if c_parse_max_seconds is not None:
+        previous = signal.signal(signal.SIGALRM, _c_parse_timeout)
+        signal.setitimer(signal.ITIMER_REAL, c_parse_max_seconds)
+    try:
+        c_parser.parse(text, subfilename)
+        return True
+    except pycparser.plyparser.ParseError:
+        return False
+    except CParseTimeout:
+        return None
+    finally:
+        if c_parse_max_seconds is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+
+def scan_c_source(source, subfilename):
+    with timing.stage("c-scan", len(source)):
+        text = source.decode("utf-8", errors="surrogateescape")
+
+        includes = [include.group(1) for include in c_include.finditer(text)]
+
+        stripped = strip_directives(text)
+        not_c = c_fast_path and has_not_c_marker(stripped)
+        num_cuda_brackets = len(cuda_bracket.findall(text))
+
+    if not_c:
+        is_c = False
+    else:
+        with timing.stage("c-parse", len(stripped)):
+            is_c = parse_is_c(stripped, subfilename)
+
+    return includes, is_c, num_cuda_brackets
+
+
+def resolve_includes(includes, names_in_repo):
+    global_include = Counter()
+    local_include = Counter()
+    for include in includes:
+        if include.split("/")[-1] in names_in_repo:
+            local_include[include] += 1
+        else:
+            global_include[include] += 1
+    return dict(global_include), dict(local_include)
+
+
+handlers = {"py": "python", "pyi": "python", "ipynb": "ipynb"}
+handlers.update((suffix, "c") for suffix in cpp_suffixes)
+
+
+def run_handler(handler, source, subfilename):
+    if handler == "python":
+        return analyze_python_source(source)
+    elif handler == "ipynb":
+        return analyze_notebook_source(source)
+    else:
+        return scan_c_source(source, subfilename)
+
+
+# part of every cache key: bump it whenever an analyzer's output changes (including upgrades of
+# jupytext or pycparser), and the cached results of the old analyzers are never looked at again
+analyzer_version = 2
+
+cache_root = "ANALYSIS-CACHE"
 
-    all_numba_references = Counter()
-    for x in visitor.all_numba_references:
-        all_numba_references[x] += 1
 
-    return {"top": dict(top_imports), "nested": nested_imports, "numba": dict(all_numba_references)}
+def cache_path(root, handler, digest):
+    if handler == "c" and not c_fast_path:
+        # --exact-c's answers are kept apart, so that they can be compared with the fast path's
+        handler += "-exact"
+    elif handler != "c" and python_libraries != pysource.default_libraries:
+        # Python results depend on which libraries' references are collected
+        handler += "-" + "+".join(python_libraries)
+    return os.path.join(root, digest[:2], f"{digest[2:]}-{handler}-{analyzer_version}.json")
 
 
-def analyze_repo(filename):
-    reponame = filename[49:-4]
+def cache_lookup(root, handler, digest):
+    """The cached result for a content hash; FileNotFoundError (or ValueError) if there is none."""
+
+    path = cache_path(root, handler, digest)
+    with open(path) as file:
+        result = json.load(file)
+    # a hit counts as a use, so that eviction removes the least recently used first
+    os.utime(path)
+    return tuple(result) if handler == "c" else result
+
+
+def cached_run_handler(handler, source, subfilename, root, digest=None):
+    """``run_handler``, remembered by content hash, so unchanged and vendored files are analyzed once."""
+
+    if root is None:
+        return timing.run_file(subfilename, len(source), run_handler, handler, source, subfilename)
+
+    try:
+        with timing.stage("cache", len(source)):
+            if digest is None:
+                digest = hashlib.sha256(source).hexdigest()
+            return cache_lookup(root, handler, digest)
+    except (FileNotFoundError, ValueError):
+        result = timing.run_file(subfilename, len(source), run_handler, handler, source, subfilename)
+        if handler == "c" and result[1] is None:
+            # over a parse budget: not the analyzer's real answer
+            return result
+        path = cache_path(root, handler, digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique temporary name: other workers may be analyzing the same file right now
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            json.dump(result, file, separators=(",", ":"))
+        os.replace(tmp, path)
+        return result
+
+
+def run_member(handler, read, subfilename, root):
+    """``cached_run_handler`` on ``read()``, but a manifest member's hash is known without reading it
+    (``read.sha256``), so on a cache hit its blob is never read or hashed."""
+
+    digest = getattr(read, "sha256", None)
+    if root is not None and digest is not None:
+        try:
+            with timing.stage("cache"):
+                return cache_lookup(root, handler, digest)
+        except (FileNotFoundError, ValueError):
+            pass
+    return cached_run_handler(handler, read_member(read), subfilename, root, digest)
+
+
+def evict_cache(root, max_bytes):
+    entries = []
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    entries.sort()
+    num_removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        num_removed += 1
+    return num_removed, total
+
+
+def resolve_link(name, links):
+    seen = set()
+    while name in links:
+        if name in seen:
+            return None
+        seen.add(name)
+        name = links[name]
+    return name
+
+
+def read_member(read):
+    if timing.recorder is None:
+        return read()
+    start = time.perf_counter()
+    source = read()
+    timing.recorder.add("read", time.perf_counter() - start, len(source))
+    return source
+
+
+def analyze_repo(filename, cache_root=None):
+    reponame = "/".join(filename[: filename.rindex(".")].split("/")[-2:])
     print(reponame)
 
+    with timing.repo(reponame):
+        repodata = analyze_members(reponame, lambda: archives.open_archive(filename, stream=True), cache_root)
+
+    print("DONE", reponame)
+    return filename + "\n", json.dumps(repodata, ensure_ascii=True, allow_nan=False, separators=(",", ":")) + "\n"
+
+
+def analyze_members(reponame, open_members, cache_root=None):
+    """The analysis of one repo; ``open_members()`` opens something ``archives.iter_members`` can read.
+
+    With a ``cache_root``, files whose content has been analyzed before are not analyzed again.
+    """
+
     repodata = {"name": reponame, "python": [], "c": [], "other_language": Counter()}
 
-    with tarfile.open(filename) as file:
-        subfilenames = file.getnames()
-        repodata["num_files"] = len(subfilenames)
-        names_in_repo = set(x.split("/")[-1] for x in subfilenames)
+    # one forward pass over the archive; local includes and links (which tarfile resolves
+    # anywhere in the archive) are settled afterward from what was collected
+    num_files = 0
+    names_in_repo = set()
+    regular = set()
+    links = {}
+    results = {}
+    entries = []
+
+    with open_members() as file:
+        for subfilename, kind, target, read in archives.iter_members(file):
+            num_files += 1
+            names_in_repo.add(subfilename.split("/")[-1])
+            if kind == "file":
+                regular.add(subfilename)
+            elif kind == "link":
+                links[subfilename] = target
 
-        for subfilename in subfilenames:
             assert subfilename[5 : 5 + len(reponame)] == reponame
             pieces = subfilename.lower().rsplit(".", 1)
             if len(pieces) != 2 or pieces[0] == "":
                 continue
 
-            if pieces[1] in ("py", "pyi"):
-                try:
-                    subfile = file.extractfile(subfilename)
-                except (KeyError, RecursionError):
-                    continue
-                if subfile is None:
-                    continue
-
-                try:
-                    syntax_tree = ast.parse(subfile.read())
-                    parsable = True
-                except:
-                    parsable = False
-
-                repodata["python"].append({
-                    "name": subfilename[5 + len(reponame) + 1:],
-                    "suffix": pieces[1],
-                    "data": analyze_python(syntax_tree) if parsable else None,
-                })
-
-            elif pieces[1] == "ipynb":
-                try:
-                    subfile = file.extractfile(subfilename)
-                except (KeyError, RecursionError):
-                    continue
-                if subfile is None:
-                    continue
-
-                try:
-                    notebook = jupytext.reads(
-                        subfile.read().decode("utf-8", errors="surrogateescape")
-                    )
-                    text = jupytext.writes(notebook, fmt="py:percent")
-                    syntax_tree = ast.parse(text)
-                    parsable = True
-                except:
-                    parsable = False
-
-                repodata["python"].append({
-                    "name": subfilename[5 + len(reponame) + 1:],
-                    "suffix": pieces[1],
-                    "data": analyze_python(syntax_tree) if parsable else None,
-                })
-
-            elif pieces[1] in cpp_suffixes:
-                try:
-                    subfile = file.extractfile(subfilename)
-                except (KeyError, RecursionError):
-                    continue
-                if subfile is None:
-                    continue
-
-                text = subfile.read().decode("utf-8", errors="surrogateescape")
-
-                global_include = Counter()
-                local_include = Counter()
-                for include in c_include.finditer(text):
-                    if include.group(1).split("/")[-1] in names_in_repo:
-                        local_include[include.group(1)] += 1
-                    else:
-                        global_include[include.group(1)] += 1
-
-                try:
-                    c_parser.parse(c_directive.sub("", text), subfilename)
-                    is_c = True
-                except pycparser.plyparser.ParseError:
-                    is_c = False
-
-                num_cuda_brackets = len(cuda_bracket.findall(text))
-
-                repodata["c"].append({
-                    "name": subfilename[5 + len(reponame) + 1:],
-                    "suffix": pieces[1],
-                    "data": {
-                        "global": dict(global_include),
-                        "local": dict(local_include),
-                        "is_c": is_c,
-                        "num_cuda": num_cuda_brackets,
-                    },
-                })
-
-            else:
+            handler = handlers.get(pieces[1])
+            if handler is None:
                 language = others.get(pieces[1])
                 if language is not None:
                     repodata["other_language"][language] += 1
+                continue
+
+            if kind == "file":
+                results[subfilename, handler] = run_member(handler, read, subfilename, cache_root)
+            elif kind != "link":
+                continue
+
+            entry = {"name": subfilename[5 + len(reponame) + 1:], "suffix": pieces[1], "data": None}
+            repodata["c" if handler == "c" else "python"].append(entry)
+            entries.append((entry, handler, subfilename, target))
+
+    repodata["num_files"] = num_files
+
+    # links to a file that went through another handler (or none) need a second, selective pass
+    keys = []
+    wanted = {}
+    for entry, handler, subfilename, target in entries:
+        if target is None:
+            key = (subfilename, handler)
+        else:
+            name = resolve_link(target, links)
+            key = (name, handler) if name in regular else None
+            if key is not None and key not in results:
+                wanted.setdefault(name, set()).add(handler)
+        keys.append(key)
+
+    if len(wanted) != 0:
+        with open_members() as file:
+            for subfilename, kind, target, read in archives.iter_members(file):
+                if kind == "file" and subfilename in wanted:
+                    source = read_member(read)
+                    for handler in wanted[subfilename]:
+                        results[subfilename, handler] = cached_run_handler(
+                            handler, source, subfilename, cache_root, getattr(read, "sha256", None)
+                        )
+
+    dropped = set()
+    for (entry, handler, subfilename, target), key in zip(entries, keys):
+        if key is None:
+            dropped.add(id(entry))
+        elif handler == "c":
+            includes, is_c, num_cuda_brackets = results[key]
+            global_include, local_include = resolve_includes(includes, names_in_repo)
+            entry["data"] = {
+                "global": global_include,
+                "local": local_include,
+                "is_c": is_c,
+                "num_cuda": num_cuda_brackets,
+            }
+        else:
+            entry["data"] = results[key]
+
+    if len(dropped) != 0:
+        repodata["python"] = [x for x in repodata["python"] if id(x) not in dropped]
+        repodata["c"] = [x for x in repodata["c"] if id(x) not in dropped]
 
     repodata["other_language"] = dict(repodata["other_language"])
+    return repodata
 
-    print("DONE", reponame)
-    return filename + "\n", json.dumps(repodata, ensure_ascii=True, allow_nan=False, separators=(",", ":")) + "\n"
 
+# cost model for scheduling, in units of analyzed bytes
+member_cost = 4096
+tgz_expansion = 4
 
-filenames = glob.glob("GitHub-numba-user-nonfork-raw-data-1Mcut-imports/*/*.tgz")
 
-try:
-    with open("input-skip.txt") as names:
-        for name in names:
-            filenames.remove(name.rstrip("\n"))
-except FileNotFoundError:
-    pass
+def estimate_cost(filename):
+    """Rough relative time to analyze a repo, from the archive's index (no decompression).
 
-print(filenames)
-raise Exception
+    Zip and manifest archives list every member with its size, so the cost is the bytes that have a
+    handler plus a fixed cost per member. A tarball has no index, so it is judged by its compressed size.
+    """
 
-with open("output-names.txt", "w") as names, open("output-errors.txt", "w") as errors, open("output-results.jsons", "w") as results:
-    with concurrent.futures.ProcessPoolExecutor() as pool:
+    try:
+        if filename.endswith(".manifest"):
+            with open(filename) as file:
+                members = [(x["name"], x.get("size", 0)) for x in json.load(file)["members"]]
+        elif filename.endswith(".zip"):
+            with zipfile.ZipFile(filename) as archive:
+                members = [(x.filename, x.file_size) for x in archive.infolist()]
+        else:
+            return tgz_expansion * os.path.getsize(filename)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return 0
+
+    cost = member_cost * len(members)
+    for name, size in members:
+        if handlers.get(name.lower().rsplit(".", 1)[-1]) is not None:
+            cost += size
+    return cost
+
+
+def schedule(filenames, costs, shard_size, num_workers):
+    """Chunks of filenames, most expensive first (longest-processing-time-first).
+
+    A chunk ends at shard_size repos or when its cost passes a small fraction of the total, so that
+    big repos get shards of their own and the cheap ones at the end fill in around them.
+    """
+
+    order = sorted(filenames, key=lambda x: -costs[x])
+    max_cost = sum(costs.values()) / (8 * num_workers)
+    chunks = []
+    chunk, chunk_cost = [], 0
+    for filename in order:
+        chunk.append(filename)
+        chunk_cost += costs[filename]
+        if len(chunk) >= shard_size or chunk_cost >= max_cost:
+            chunks.append(chunk)
+            chunk, chunk_cost = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def shard_filename(shard_dir, index):
+    return os.path.join(shard_dir, f"shard-{index:06d}")
+
+
+def _commit(file, tmp_filename, filename):
+    # on disk before it has its final name, so a crash leaves either nothing or the whole file
+    file.flush()
+    os.fsync(file.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def analyze_shard(shard_dir, index, filenames, cache_root=None, timing_options=None):
+    """Analyze a few repos into one gzipped shard of JSON lines, committed by writing its marker last.
+
+    A shard without a marker (the worker died) is ignored, and its repos are analyzed again.
+    With ``timing_options`` (arguments of ``timing.enable``), the shard's timings are returned too.
+    """
+
+    if timing_options is not None:
+        timing.enable(**timing_options)
+    done = []
+    errors = []
+    data_filename = shard_filename(shard_dir, index) + ".jsons.gz"
+    with open(data_filename + ".tmp", "wb") as raw:
+        with gzip.open(raw, "wt", compresslevel=6) as file:
+            for filename in filenames:
+                try:
+                    _, result = analyze_repo(filename, cache_root)
+                except Exception as err:
+                    errors.append((filename, f"{err!r}"))
+                else:
+                    file.write(result)
+                    done.append(filename)
+        _commit(raw, data_filename + ".tmp", data_filename)
+
+    marker_filename = shard_filename(shard_dir, index) + ".done"
+    with open(marker_filename + ".tmp", "w") as file:
+        json.dump({"filenames": done, "errors": errors}, file)
+        _commit(file, marker_filename + ".tmp", marker_filename)
+    return index, len(done), len(errors), timing.take()
+
+
+def committed_shards(shard_dir):
+    markers = {}
+    for marker_filename in glob.glob(os.path.join(shard_dir, "shard-*.done")):
+        with open(marker_filename) as file:
+            markers[int(marker_filename[-11:-5])] = json.load(file)
+    return markers
+
+
+def journal_shard(journal, index, marker):
+    # one "index<TAB>ok|error<TAB>filename" line per repo, on disk before the next shard is counted
+    journal.writelines(f"{index}\tok\t{x}\n" for x in marker["filenames"])
+    journal.writelines(f"{index}\terror\t{x}\n" for x, _ in marker["errors"])
+    journal.flush()
+    os.fsync(journal.fileno())
+
+
+def resume_shards(shard_dir):
+    """(set of repos already done, next shard index), after clearing out what a killed run left.
+
+    The journal is the record of finished repos. A shard whose marker was written but not journaled
+    (killed in between) is journaled now; a shard without a marker, and any .tmp file, is deleted,
+    so those repos are analyzed again. Repos that failed are not done: they are retried on every run
+    (until they are put in input-skip.txt).
+    """
+
+    os.makedirs(shard_dir, exist_ok=True)
+    journal_filename = os.path.join(shard_dir, "journal.txt")
+    done = set()
+    journaled = set()
+    complete = 0
+    if os.path.exists(journal_filename):
+        with open(journal_filename, "rb") as file:
+            data = file.read()
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].decode("utf-8", "surrogateescape").splitlines():
+            index, status, filename = line.split("\t", 2)
+            journaled.add(int(index))
+            if status == "ok":
+                done.add(filename)
+
+    markers = committed_shards(shard_dir)
+    with open(journal_filename, "a+b") as file:
+        # a line cut off by the kill is dropped
+        file.truncate(complete)
+    with open(journal_filename, "a", encoding="utf-8", errors="surrogateescape") as journal:
+        for index in sorted(set(markers) - journaled):
+            journal_shard(journal, index, markers[index])
+            done.update(markers[index]["filenames"])
+
+    for filename in glob.glob(os.path.join(shard_dir, "shard-*")):
+        if filename.endswith(".tmp") or (filename.endswith(".jsons.gz") and int(filename[-15:-9]) not in markers):
+            os.remove(filename)
+
+    return done, max(markers, default=-1) + 1
+
+
+def merge_shards(shard_dir, columnar_writer=None):
+    """Compact all committed shards into output-results.jsons, output-names.txt, and output-errors.txt.
+
+    A repo that failed and was retried is listed in output-errors.txt only if it never succeeded,
+    with its last error.
+    """
+
+    markers = committed_shards(shard_dir)
+    succeeded = set()
+    last_errors = {}
+    for index in sorted(markers):
+        succeeded.update(markers[index]["filenames"])
+        last_errors.update((filename, index) for filename, _ in markers[index]["errors"])
+    outputs = ["output-results.jsons", "output-names.txt", "output-errors.txt"]
+    with open(outputs[0] + ".tmp", "w") as results, open(outputs[1] + ".tmp", "w") as names, open(
+        outputs[2] + ".tmp", "w"
+    ) as errors:
+        for index in sorted(markers):
+            with gzip.open(shard_filename(shard_dir, index) + ".jsons.gz", "rt") as file:
+                for line in file:
+                    results.write(line)
+                    if columnar_writer is not None:
+                        columnar_writer.add(json.loads(line))
+            names.writelines(x + "\n" for x in markers[index]["filenames"])
+            errors.writelines(
+                f"{filename}\t{message}\n"
+                for filename, message in markers[index]["errors"]
+                if filename not in succeeded and last_errors[filename] == index
+            )
+    for output in outputs:
+        os.replace(output + ".tmp", output)
+    return markers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static analysis of the archived repos.")
+    parser.add_argument(
+        "--selected",
+        default=None,
+        help=f"list of archives written by step4.py (default: {step4.selected_filename} if it exists, "
+        "otherwise every archive in GitHub-numba-user-nonfork-raw-data-1Mcut-imports)",
+    )
+    parser.add_argument("--cache-dir", default=cache_root, help="per-file results, by content hash")
+    parser.add_argument("--cache-size", type=float, default=2000, help="MB to keep in the cache after the run")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument(
+        "--exact-c",
+        action="store_true",
+        help="run pycparser on every C/C++ file, as before the fast path (cached apart from the fast path's results)",
+    )
+    parser.add_argument("--c-max-bytes", type=int, default=None, help="is_c = null for larger files")
+    parser.add_argument("--c-max-seconds", type=float, default=None, help="is_c = null for slower parses")
+    parser.add_argument(
+        "--libraries",
+        nargs="+",
+        default=list(pysource.default_libraries),
+        help="collect references to each of these in Python files (step 4 must have selected for them, too)",
+    )
+    parser.add_argument("--shards", default="OUTPUT-SHARDS", help="directory for each worker's compressed results")
+    parser.add_argument("--shard-size", type=int, default=16, help="repos per shard")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: one per CPU)")
+    parser.add_argument(
+        "--no-schedule", action="store_true", help="dispatch in input order, not most expensive first"
+    )
+    parser.add_argument("--remove-shards", action="store_true", help="after they have been merged")
+    parser.add_argument(
+        "--timing", default=None, help="write wall time and bytes per stage, repo, and slow file to this JSON file"
+    )
+    parser.add_argument("--slow-seconds", type=float, default=1.0, help="with --timing, log files slower than this")
+    parser.add_argument(
+        "--profile-dir", default=None, help="with --timing, rerun each slow file under cProfile and save it here"
+    )
+    parser.add_argument(
+        "--columnar", default=None, help="also write the results as tables in this directory (needs pyarrow)"
+    )
+    args = parser.parse_args()
+    timing_options = None
+    if args.timing is not None:
+        timing_options = {"slow_seconds": args.slow_seconds, "profile_dir": args.profile_dir}
+    task = functools.partial(
+        analyze_shard,
+        args.shards,
+        cache_root=None if args.no_cache else args.cache_dir,
+        timing_options=timing_options,
+    )
+
+    if args.selected is None and os.path.exists(step4.selected_filename):
+        args.selected = step4.selected_filename
+    if args.selected is not None:
+        print(f"analyzing the archives listed in {args.selected}", flush=True)
+        with open(args.selected) as file:
+            filenames = [x.rstrip("\n") for x in file]
+    else:
+        filenames = glob.glob("GitHub-numba-user-nonfork-raw-data-1Mcut-imports/*/*.tgz")
+        filenames += glob.glob("GitHub-numba-user-nonfork-raw-data-1Mcut-imports/*/*.zip")
+        filenames += glob.glob("GitHub-numba-user-nonfork-raw-data-1Mcut-imports/*/*.manifest")
+
+    # by hand, e.g. repos known to break the analysis
+    skip = set()
+    try:
+        with open("input-skip.txt") as names:
+            skip.update(name.rstrip("\n") for name in names)
+    except FileNotFoundError:
+        pass
+
+    columnar_writer = None
+    if args.columnar is not None:
+        import columnar
+
+        columnar_writer = columnar.ResultWriter(args.columnar)
+
+    # repos in committed shards are not analyzed again, except any that failed
+    done, first_index = resume_shards(args.shards)
+    todo = [x for x in filenames if x not in done and x not in skip]
+    print(f"{len(filenames) - len(todo)} repos done or skipped, {len(todo)} to do", flush=True)
+
+    num_workers = os.cpu_count() if args.workers is None else args.workers
+    if args.no_schedule:
+        chunks = [todo[i : i + args.shard_size] for i in range(0, len(todo), args.shard_size)]
+    else:
+        chunks = schedule(todo, {x: estimate_cost(x) for x in todo}, args.shard_size, num_workers)
+
+    num_done = 0
+    timings = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        num_workers,
+        initializer=configure_worker,
+        initargs=(not args.exact_c, args.c_max_bytes, args.c_max_seconds, args.libraries),
+    ) as pool, open(
+        os.path.join(args.shards, "journal.txt"), "a", encoding="utf-8", errors="surrogateescape"
+    ) as journal:
         start = time.time()
-        for i, (name, result) in enumerate(pool.map(analyze_repo, filenames, chunksize=1)):
-        # for i, (name, result) in enumerate(analyze_repo(x) for x in filenames):
-            if name is None:
-                errors.write(result)
-                errors.flush()
-            else:
-                results.write(result)
-                results.flush()
-                names.write(name)
-                names.flush()
-                now = int(time.time() - start)
-                print(
-                    f"{now // 3600}:{(now % 3600) // 60:02d}:{now % 60:02d}: {i+1}/{len(filenames)} = {(i+1)/len(filenames)}",
-                    flush=True,
-                )
+        futures = [pool.submit(task, first_index + i, chunk) for i, chunk in enumerate(chunks)]
+        # in order of completion, so that a slow repo holds up only its own shard
+        for future in concurrent.futures.as_completed(futures):
+            index, num_good, num_bad, shard_timings = future.result()
+            if shard_timings is not None:
+                timing.merge(timings, shard_timings)
+            with open(shard_filename(args.shards, index) + ".done") as file:
+                journal_shard(journal, index, json.load(file))
+            num_done += num_good + num_bad
+            now = int(time.time() - start)
+            print(
+                f"{now // 3600}:{(now % 3600) // 60:02d}:{now % 60:02d}: shard {index} ({num_bad} errors), {num_done}/{len(todo)} = {num_done/len(todo)}",
+                flush=True,
+            )
+
+    if args.timing is not None:
+        with open(args.timing, "w") as file:
+            json.dump(timings, file)
+        print(timing.report(timings), flush=True)
+
+    merge_shards(args.shards, columnar_writer)
+    if args.remove_shards:
+        shutil.rmtree(args.shards)
+
+    if columnar_writer is not None:
+        columnar_writer.close()
+
+    if not args.no_cache:
+        num_removed, total = evict_cache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+        print(f"cache: removed {num_removed} least recently used, {total / 1e6:.1f} MB kept", flush=True)
@@ -0,0 +1,330 @@
+"""Fake repos with realistic content, for benchmarking and checking the analysis without the real corpus.
+
+``make_corpus(num_repos, seed, ...)`` writes ``GitHub-numba-user-nonfork-raw-data-1Mcut-imports/*/*.tgz``
+in the current directory, laid out like step3.py's tarballs: Python files with the usual numba
+import and alias patterns (and some without numba, and some that don't parse), notebooks with
+large base64 outputs, C, C++, and CUDA sources with local and system includes, other languages,
+and READMEs. ``make_contents(filename, num_repos, seed)`` writes a ``numba-dependents-contents.tgz``
+of JSONL files like the one 2024-10-30/collect-imports-and-strings.py produced, for
+2024-10-30/find-import-numba.py.
+
+The same arguments always give the same bytes.
+"""
+
+import argparse
+import base64
+import gzip
+import io
+import json
+import os
+import random
+import tarfile
+
+corpus_dir = "GitHub-numba-user-nonfork-raw-data-1Mcut-imports"
+
+# how numba gets into a module: (import statements, the name numba is known by)
+numba_imports = [
+    ("import numba", "numba"),
+    ("import numba as nb", "nb"),
+    ("import numba as numba_", "numba_"),
+    ("from numba import jit, njit, prange, vectorize, cuda", None),
+    ("from numba import njit as fast", None),
+    ("import numba.cuda\nimport numba", "numba"),
+    ("from numba.core import types\nimport numba", "numba"),
+]
+
+other_imports = ["numpy as np", "os", "sys", "math", "scipy.sparse", "pandas as pd", "awkward as ak", "typing"]
+
+
+def python_source(rng, numba_fraction=0.7, num_functions=(2, 12)):
+    lines = ['"""A module."""', ""]
+    for x in rng.sample(other_imports, rng.randint(1, 4)):
+        lines.append(f"import {x}")
+
+    use_numba = rng.random() < numba_fraction
+    if use_numba:
+        statements, name = rng.choice(numba_imports)
+        lines.extend(statements.split("\n"))
+        if name is None:
+            decorators = ["@jit", "@njit", "@njit(parallel=True, cache=True)", "@vectorize(['float64(float64)'])"]
+            if "fast" in statements:
+                decorators = ["@fast", "@fast(nogil=True)"]
+            elif "cuda" in statements:
+                decorators.append("@cuda.jit")
+        else:
+            decorators = [
+                f"@{name}.jit",
+                f"@{name}.njit",
+                f"@{name}.jit(nopython=True)",
+                f"@{name}.njit(parallel=True, fastmath=True)",
+                f"@{name}.vectorize(['float64(float64, float64)'], target='parallel')",
+                f"@{name}.cuda.jit",
+                f"@{name}.experimental.jitclass([('x', {name}.float64)])",
+            ]
+    lines.append("")
+
+    for i in range(rng.randint(*num_functions)):
+        lines.append("")
+        if use_numba and rng.random() < 0.6:
+            lines.append(rng.choice(decorators))
+        lines.append(f"def function_{i}(x, y={i}):")
+        lines.append(f'    """Does thing number {i}."""')
+        kind = rng.randrange(4)
+        if kind == 0:
+            lines.append("    out = 0.0")
+            loop = f"{name}.prange" if use_numba and name is not None else "range"
+            lines.append(f"    for j in {loop}(len(x)):")
+            lines.append("        out += x[j] * y + (j % 3) - (j // 7)")
+            lines.append("    return out")
+        elif kind == 1:
+            lines.append("    import itertools")
+            lines.append("    return [a + b for a, b in itertools.product(x, range(y)) if a > b]")
+        elif kind == 2 and use_numba and name is not None:
+            lines.append(f"    f = {name}.njit(lambda z: z + 1)")
+            lines.append(f"    return f(x) if {name}.config.DISABLE_JIT else {name}.typeof(x)")
+        else:
+            lines.append("    return {'x': x, 'y': y, 'z': [x, y, (x, y)]}")
+
+    lines.append("")
+    lines.append("")
+    lines.append("class Thing:")
+    lines.append("    def method(self, x):")
+    lines.append("        return function_0(x) + 1")
+    lines.append("")
+    return "\n".join(lines).encode()
+
+
+def broken_python_source(rng):
+    # Python 2, which ast.parse rejects
+    return b"import numba\nprint 'hello'\ndef f(x):\n    exec 'x = 1'\n"
+
+
+def notebook_source(rng, num_cells=(4, 20), output_bytes=200000):
+    cells = []
+    for i in range(rng.randint(*num_cells)):
+        if rng.random() < 0.3:
+            cells.append({"cell_type": "markdown", "metadata": {}, "source": [f"## Step {i}\n", "Some *text* about numba.\n"]})
+            continue
+        source = python_source(rng, num_functions=(0, 2)).decode()
+        outputs = []
+        if rng.random() < 0.5:
+            outputs.append({"name": "stdout", "output_type": "stream", "text": [f"{j}\n" for j in range(20)]})
+        if output_bytes > 0 and rng.random() < 0.3:
+            image = base64.b64encode(rng.randbytes(output_bytes * 3 // 4)).decode()
+            outputs.append(
+                {
+                    "data": {"image/png": image, "text/plain": ["<Figure size 640x480 with 1 Axes>"]},
+                    "metadata": {"needs_background": "light"},
+                    "output_type": "display_data",
+                }
+            )
+        cells.append(
+            {
+                "cell_type": "code",
+                "execution_count": i,
+                "metadata": {"collapsed": False},
+                "outputs": outputs,
+                "source": source.splitlines(True),
+            }
+        )
+    notebook = {
+        "cells": cells,
+        "metadata": {
+            "kernelspec": {"display_name": "Python 3", "language": "python", "name": "python3"},
+            "language_info": {"name": "python", "version": "3.11.0"},
+        },
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+    return json.dumps(notebook, indent=1).encode()
+
+
+def c_source(rng, local_headers, flavor=None):
+    flavor = rng.choice(["c", "cpp", "cuda"]) if flavor is None else flavor
+    lines = ["#include <stdio.h>", "#include <stdlib.h>", "#include <math.h>"]
+    if flavor == "cpp":
+        lines.extend(["#include <vector>", "#include <string>"])
+    if flavor == "cuda":
+        lines.append("#include <cuda_runtime.h>")
+    for header in rng.sample(local_headers, min(len(local_headers), rng.randint(0, 2))):
+        lines.append(f'#include "{header}"')
+    lines.append("")
+    lines.append("#define N 1024")
+    lines.append("")
+
+    # pycparser (without a preprocessor) rejects comments, so only some files have them
+    comment = "  /* a comment */" if rng.random() < 0.5 else ""
+    for i in range(rng.randint(2, 10)):
+        if flavor == "cpp" and i == 0:
+            lines.append("namespace fake {")
+            lines.append("template <typename T>")
+            lines.append("class Buffer {")
+            lines.append(" public:")
+            lines.append("  std::vector<T> data;")
+            lines.append("};")
+            lines.append("}")
+        elif flavor == "cuda" and i == 0:
+            lines.append("__global__ void kernel(double* x, int n) {")
+            lines.append("  int i = blockIdx.x * blockDim.x + threadIdx.x;")
+            lines.append("  if (i < n) x[i] = 2.0 * x[i];")
+            lines.append("}")
+            lines.append("")
+            lines.append("void launch(double* x, int n) {")
+            lines.append("  kernel<<<(n + 255) / 256, 256>>>(x, n);")
+            lines.append("}")
+        else:
+            lines.append(f"double function_{i}(double* x, int n) {{")
+            lines.append("  double out = 0.0;")
+            lines.append("  int j;")
+            lines.append("  for (j = 0; j < n; j++) {")
+            lines.append(f"    out += sqrt(x[j]) * {i};{comment}")
+            lines.append("  }")
+            lines.append('  printf("%f\\n", out);')
+            lines.append("  return out;")
+            lines.append("}")
+        lines.append("")
+    return "\n".join(lines).encode()
+
+
+def repo_files(rng, num_python=(1, 10), num_notebooks=(0, 2), num_c=(0, 4), output_bytes=200000):
+    """(path, bytes) of one repo's files."""
+
+    files = [("README.md", b"# A project\n\nIt uses numba to be fast.\n" * rng.randint(1, 50))]
+    for i in range(rng.randint(*num_python)):
+        directory = rng.choice(["", "src/", "src/package/", "tests/"])
+        if rng.random() < 0.03:
+            files.append((f"{directory}old_{i}.py", broken_python_source(rng)))
+        else:
+            files.append((f"{directory}module_{i}.py", python_source(rng)))
+    for i in range(rng.randint(*num_notebooks)):
+        files.append((f"notebooks/analysis_{i}.ipynb", notebook_source(rng, output_bytes=output_bytes)))
+
+    num = rng.randint(*num_c)
+    headers = [f"header_{i}.h" for i in range(num // 2)]
+    for header in headers:
+        files.append((f"csrc/{header}", c_source(rng, [], "c")))
+    for i in range(num - len(headers)):
+        flavor = rng.choice(["c", "cpp", "cuda"])
+        suffix = {"c": "c", "cpp": "cpp", "cuda": "cu"}[flavor]
+        files.append((f"csrc/source_{i}.{suffix}", c_source(rng, headers, flavor)))
+
+    for suffix in rng.sample(["f90", "jl", "rs", "pyx", "java", "txt"], rng.randint(0, 3)):
+        files.append((f"other/file.{suffix}", b"! some other language\n" * 10))
+    return files
+
+
+def write_repo(filename, reponame, files):
+    # fixed mtimes, so that the same files give the same bytes
+    with open(filename, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as compressed:
+        with tarfile.open(fileobj=compressed, mode="w") as file:
+            for path, data in files:
+                info = tarfile.TarInfo(f"REPO/{reponame}/{path}")
+                info.size = len(data)
+                info.mtime = 0
+                file.addfile(info, io.BytesIO(data))
+
+
+def make_corpus(num_repos, seed=12345, num_big=0, big_python=(1000, 1500), **mix):
+    """Writes the repos in the current directory and returns their filenames; the big ones sort last.
+
+    ``mix`` is passed to ``repo_files``: ranges of numbers of Python, notebook, and C files per repo,
+    and the size of each notebook image output.
+    """
+
+    rng = random.Random(seed)
+    filenames = []
+    for i in range(num_repos):
+        if i >= num_repos - num_big:
+            user = f"zz-big{i:05d}"
+            files = repo_files(rng, **dict(mix, num_python=big_python))
+        else:
+            user = f"user{i:05d}"
+            files = repo_files(rng, **mix)
+        os.makedirs(f"{corpus_dir}/{user}", exist_ok=True)
+        filename = f"{corpus_dir}/{user}/repo{i % 7}.tgz"
+        write_repo(filename, f"{user}/repo{i % 7}", files)
+        filenames.append(filename)
+    return filenames
+
+
+def contents_record(rng, repo):
+    # one line of collect-imports-and-strings.py's output
+    if rng.random() < 0.05:
+        return {"repo": repo, "success": False}
+    # about a fifth of the real ones import numba, and most have READMEs
+    uses_numba = rng.random() < 0.215
+    files = []
+    if rng.random() < 0.85:
+        readme = "# A project\n" + "Some words about the project. " * rng.randint(10, 2000)
+        if rng.random() < 0.2:
+            # a copy that os.walk found first: the README's text is written only there
+            files.append({"name": "/docs/README.md", "text": [readme]})
+            files.append({"name": "/README.md", "same_text_as": "/docs/README.md"})
+        else:
+            files.append({"name": "/README.md", "text": [readme]})
+    for i in range(rng.randint(1, 30)):
+        imports = sorted(rng.sample(["numpy", "os", "sys", "scipy.sparse", "pandas", "typing", "matplotlib.pyplot"], 3))
+        references = {}
+        if uses_numba and (i == 0 or rng.random() < 0.3):
+            imports.append(rng.choice(["numba", "numba.cuda", "numba.core.types"]))
+            references = {"numba.njit": rng.randint(1, 5), "@numba.njit": rng.randint(0, 5)}
+        files.append(
+            {
+                "name": f"/src/module_{i}.py",
+                "parse": True,
+                "text": [f"Does thing number {j}." * rng.randint(1, 20) for j in range(rng.randint(0, 10))],
+                "imports": sorted(imports),
+                # step5.py's analysis, which collect-imports-and-strings.py writes for every Python file
+                "data": {"top": {x.split(".")[0]: 1 for x in imports}, "nested": {}, "numba": references},
+            }
+        )
+    if rng.random() < 0.3:
+        files.append({"name": "/docs/index.rst", "text": ["Docs about numba. " * rng.randint(100, 5000)]})
+    return {"repo": repo, "success": True, "files": files}
+
+
+def make_contents(filename, num_repos, seed=12345, repos_per_member=100):
+    """Writes a numba-dependents-contents.tgz: a tarball of JSONL files, one repo per line."""
+
+    rng = random.Random(seed)
+    with open(filename, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as compressed:
+        with tarfile.open(fileobj=compressed, mode="w") as file:
+            for start in range(0, num_repos, repos_per_member):
+                lines = []
+                for i in range(start, min(num_repos, start + repos_per_member)):
+                    record = contents_record(rng, f"user{i:05d}/repo{i % 7}")
+                    lines.append(json.dumps(record) + "\n")
+                data = "".join(lines).encode()
+                info = tarfile.TarInfo(f"RESULTS/part-{start // repos_per_member:05d}.jsonl")
+                info.size = len(data)
+                info.mtime = 0
+                file.addfile(info, io.BytesIO(data))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=f"Write fake repos into {corpus_dir} in the current directory.")
+    parser.add_argument("--repos", type=int, default=100)
+    parser.add_argument("--big", type=int, default=0, help="how many of the repos have 1000-1500 Python files")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--python", type=int, nargs=2, default=(1, 10), help="min and max Python files per repo")
+    parser.add_argument("--notebooks", type=int, nargs=2, default=(0, 2), help="min and max notebooks per repo")
+    parser.add_argument("--c", type=int, nargs=2, default=(0, 4), help="min and max C/C++/CUDA files per repo")
+    parser.add_argument("--output-bytes", type=int, default=200000, help="size of each notebook image output")
+    parser.add_argument(
+        "--contents", type=int, default=0, help="also write numba-dependents-contents.tgz with this many repos"
+    )
+    args = parser.parse_args()
+
+    filenames = make_corpus(
+        args.repos,
+        args.seed,
+        args.big,
+        num_python=tuple(args.python),
+        num_notebooks=tuple(args.notebooks),
+        num_c=tuple(args.c),
+        output_bytes=args.output_bytes,
+    )
+    print(f"wrote {len(filenames)} repos, {sum(os.path.getsize(x) for x in filenames) / 1e6:.1f} MB")
+    if args.contents > 0:
+        make_contents("numba-dependents-contents.tgz", args.contents, args.seed)
+        print(f"wrote numba-dependents-contents.tgz, {os.path.getsize('numba-dependents-contents.tgz') / 1e6:.1f} MB")
@@ -0,0 +1,115 @@
+"""Drives step1.crawl through test-step1-pages/ on a local server.
+
+The pages have the markup of GitHub's dependents pages (only the parts that step1.parse_page reads).
+The server answers page 2 with a 429 and then a 500 before serving it, so the crawl has to wait
+them out, and answers page 3 with a 404 the first time, so the crawl fails there. Running it again
+resumes from the checkpoint at page 3 without fetching pages 1 and 2 again, and a third run finds
+the crawl complete. Exits with status 1 if anything is not as expected.
+"""
+
+import collections
+import http.server
+import os
+import sys
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+import step1
+
+pages_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test-step1-pages")
+
+# dependents_after cursor -> page
+pages = {None: "page-1.html", "MTAwMA": "page-2.html", "MjAwMA": "page-3.html"}
+
+# page -> status codes to answer with before serving it
+failures = {"page-2.html": [429, 500], "page-3.html": [404]}
+
+expected = [
+    "alice/fast-physics",
+    "bob/jit-sandbox",
+    "carol/nbody",
+    "dave/raytracer",
+    "erin/numba-tutorial",
+    "frank/finance-sim",
+    "grace/ufuncs",
+]
+
+requests_seen = collections.Counter()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        if parts.path != "/numba/numba/network/dependents" or query.get("dependent_type") != ["REPOSITORY"]:
+            self.send_error(404)
+            return
+        page = pages.get(query.get("dependents_after", [None])[0])
+        if page is None:
+            self.send_error(404)
+            return
+
+        requests_seen[page] += 1
+        if len(failures.get(page, [])) != 0:
+            status = failures[page].pop(0)
+            self.send_response(status)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        with open(os.path.join(pages_dir, page), "rb") as file:
+            body = file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    with tempfile.TemporaryDirectory() as workdir:
+        output = os.path.join(workdir, "numba-dependents.txt")
+        checkpoint = output + ".checkpoint"
+        args = (base_url, "numba/numba", "REPOSITORY", output, checkpoint, None, 0.01)
+
+        # first run: through the 429 and 500 on page 2, then stopped by the 404 on page 3
+        failed = []
+        step1.crawl_thread(failed, *args)
+        check(len(failed) == 1, "the 404 was not reported as a failure")
+        check(requests_seen["page-2.html"] == 3, f"page 2 was requested {requests_seen['page-2.html']} times, not 3")
+        check(step1.load_checkpoint(checkpoint)["url"].endswith("dependents_after=MjAwMA"), "no checkpoint at page 3")
+
+        # second run: resumes at page 3
+        failed = []
+        step1.crawl_thread(failed, *args)
+        check(len(failed) == 0, f"the resumed crawl failed: {failed}")
+        check(requests_seen["page-1.html"] == 1, "page 1 was fetched again")
+        check(requests_seen["page-2.html"] == 3, "page 2 was fetched again")
+        check(step1.load_checkpoint(checkpoint) == {"url": None}, "the checkpoint does not say the crawl is complete")
+
+        # third run: nothing to do
+        before = sum(requests_seen.values())
+        check(step1.crawl(*args) == len(expected), "the complete crawl has the wrong number of repos")
+        check(sum(requests_seen.values()) == before, "the complete crawl made requests")
+
+        with open(output) as file:
+            found = [x.rstrip("\n") for x in file]
+        check(found == expected, f"wrong output: {found}")
+
+    server.shutdown()
+    print(f"crawled {len(expected)} repos from {len(pages)} pages through a 429, a 500, a 404, and a resume")
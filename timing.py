@@ -0,0 +1,203 @@
+"""Wall time and bytes per stage of step5.py's analysis, and the slow files that set the tail of a run.
+
+Nothing is recorded until ``enable()`` is called (in each worker process). Then
+
+* ``stage(name, num_bytes)`` times one stage of one file: ``read`` (decompressing the member),
+  ``cache`` (hashing and the cache lookup), ``notebook`` (JSON to Python source), ``parse``
+  (``ast.parse``), ``walk`` (``pysource.extract``), ``c-scan`` (includes and markers), or
+  ``c-parse`` (pycparser);
+* ``run_file(path, size, function, ...)`` times a whole file's analysis, and logs it with its
+  path, size, and slowest stage if it took more than ``slow_seconds``, rerunning it under
+  cProfile if there is a ``profile_dir``;
+* ``repo(name)`` collects the stages of one repo into a per-repo record.
+
+``take()`` returns what has been recorded since the last ``take()`` as plain data (to send back
+from a worker), and ``merge`` and ``report`` combine and print it in the parent.
+"""
+
+import contextlib
+import cProfile
+import math
+import os
+import time
+
+# histograms have one bin per power of two of microseconds
+num_bins = 40
+
+recorder = None
+
+
+class Recorder:
+    def __init__(self, slow_seconds=None, profile_dir=None):
+        self.slow_seconds = slow_seconds
+        self.profile_dir = profile_dir
+        self.paused = False
+        self.repo_name = None
+        self.path = None
+        self.file_stages = {}
+        self.clear()
+
+    def clear(self):
+        self.stages = {}
+        self.histograms = {}
+        self.slow = []
+        self.repos = []
+        self.repo_stages = {}
+
+    def add(self, name, seconds, num_bytes):
+        if self.paused:
+            return
+        totals = self.stages.get(name)
+        if totals is None:
+            totals = self.stages[name] = [0, 0.0, 0]
+            self.histograms[name] = [0] * num_bins
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += num_bytes
+        self.histograms[name][min(num_bins - 1, max(0, math.ceil(math.log2(max(seconds, 1e-9) * 1e6))))] += 1
+
+        for per in (self.repo_stages, self.file_stages):
+            per[name] = per.get(name, 0.0) + seconds
+        if name == "read":
+            self.repo_stages["bytes"] = self.repo_stages.get("bytes", 0) + num_bytes
+
+    @contextlib.contextmanager
+    def stage(self, name, num_bytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, num_bytes)
+
+    @contextlib.contextmanager
+    def repo(self, name):
+        self.repo_name = name
+        self.repo_stages = {}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stages = {k: v for k, v in self.repo_stages.items() if k != "bytes"}
+            self.repos.append(
+                {"repo": name, "seconds": seconds, "bytes": self.repo_stages.get("bytes", 0), "stages": stages}
+            )
+            self.repo_name = None
+
+    def run_file(self, path, size, function, *args):
+        self.path = path
+        self.file_stages = {}
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            if self.slow_seconds is not None and seconds > self.slow_seconds and not self.paused:
+                self.log_slow(path, size, seconds, function, args)
+            self.path = None
+
+    def log_slow(self, path, size, seconds, function, args):
+        slowest = max(self.file_stages, key=self.file_stages.get, default=None)
+        entry = {"repo": self.repo_name, "path": path, "size": size, "seconds": seconds, "stage": slowest}
+        if self.profile_dir is not None:
+            # a second run, not counted in the stages, since profiling the first would slow every file
+            os.makedirs(self.profile_dir, exist_ok=True)
+            entry["profile"] = os.path.join(self.profile_dir, f"{os.getpid()}-{len(self.slow)}.prof")
+            profile = cProfile.Profile()
+            self.paused = True
+            try:
+                profile.runcall(function, *args)
+            except Exception:
+                pass
+            finally:
+                self.paused = False
+            profile.dump_stats(entry["profile"])
+        self.slow.append(entry)
+
+    def take(self):
+        out = {"stages": self.stages, "histograms": self.histograms, "slow": self.slow, "repos": self.repos}
+        self.clear()
+        return out
+
+
+def enable(slow_seconds=None, profile_dir=None):
+    global recorder
+    if recorder is None:
+        recorder = Recorder(slow_seconds, profile_dir)
+    return recorder
+
+
+_not_recording = contextlib.nullcontext()
+
+
+def stage(name, num_bytes=0):
+    if recorder is None:
+        return _not_recording
+    return recorder.stage(name, num_bytes)
+
+
+def repo(name):
+    if recorder is None:
+        return _not_recording
+    return recorder.repo(name)
+
+
+def run_file(path, size, function, *args):
+    if recorder is None:
+        return function(*args)
+    return recorder.run_file(path, size, function, *args)
+
+
+def take():
+    if recorder is None:
+        return None
+    return recorder.take()
+
+
+def merge(summary, other):
+    """Adds one ``take()`` into another (or into an empty dict)."""
+
+    for name, (count, seconds, num_bytes) in other["stages"].items():
+        totals = summary.setdefault("stages", {}).setdefault(name, [0, 0.0, 0])
+        totals[0] += count
+        totals[1] += seconds
+        totals[2] += num_bytes
+        histogram = summary.setdefault("histograms", {}).setdefault(name, [0] * num_bins)
+        for i, x in enumerate(other["histograms"][name]):
+            histogram[i] += x
+    summary.setdefault("slow", []).extend(other["slow"])
+    summary.setdefault("repos", []).extend(other["repos"])
+    return summary
+
+
+def _quantile(histogram, fraction):
+    # upper edge of the bin, in seconds
+    target = fraction * sum(histogram)
+    running = 0
+    for i, x in enumerate(histogram):
+        running += x
+        if running >= target:
+            return 2**i / 1e6
+    return 2 ** (num_bins - 1) / 1e6
+
+
+def report(summary, num_slowest=10):
+    lines = [
+        f"{'stage':10s} {'count':>9s} {'seconds':>10s} {'MB':>10s} {'files/s':>9s} {'MB/s':>8s} "
+        f"{'p50':>9s} {'p99':>9s} {'max':>9s}"
+    ]
+    for name, (count, seconds, num_bytes) in sorted(summary.get("stages", {}).items(), key=lambda x: -x[1][1]):
+        histogram = summary["histograms"][name]
+        files_rate = f"{count / seconds:9.0f}" if seconds != 0 else f"{'':9s}"
+        rate = f"{num_bytes / 1e6 / seconds:8.1f}" if num_bytes != 0 and seconds != 0 else f"{'':8s}"
+        lines.append(
+            f"{name:10s} {count:9d} {seconds:10.2f} {num_bytes / 1e6:10.1f} {files_rate} {rate} "
+            f"{_quantile(histogram, 0.5):9.2g} {_quantile(histogram, 0.99):9.2g} {_quantile(histogram, 1):9.2g}"
+        )
+    repos = sorted(summary.get("repos", []), key=lambda x: -x["seconds"])
+    for x in repos[:num_slowest]:
+        stages = ", ".join(f"{k} {v:.2f}" for k, v in sorted(x["stages"].items(), key=lambda y: -y[1]))
+        lines.append(f"slow repo {x['seconds']:8.2f} s {x['repo']} ({stages})")
+    for x in sorted(summary.get("slow", []), key=lambda x: -x["seconds"])[:num_slowest]:
+        lines.append(f"slow file {x['seconds']:8.2f} s {x['path']} ({x['size']} bytes, mostly {x['stage']})")
+    return "\n".join(lines)